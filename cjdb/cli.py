@@ -5,6 +5,8 @@ from cjdb.logger import logger
 from cjdb import __version__
 from cjdb.modules.importer import Importer
 from cjdb.modules.exporter import Exporter
+from cjdb.modules.schema import PARTITION_KEYS
+from cjdb.modules.storage import STORAGE_FORMATS
 from cjdb.modules.utils import get_db_engine, get_db_psycopg_conn
 from cjdb.resources import strings as s
 
@@ -83,6 +85,112 @@ def cjdb(ctx):
     default=False,
     help=s.transform_help,
 )
+@click.option(
+    "--batch-size",
+    "batch_size",
+    type=click.IntRange(min=1),
+    default=1000,
+    help=s.batch_size_help,
+)
+@click.option(
+    "--batch-memory",
+    "batch_memory",
+    type=click.IntRange(min=1),
+    default=64,
+    help=s.batch_memory_help,
+)
+@click.option(
+    "--jobs",
+    "-j",
+    "jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help=s.jobs_help,
+)
+@click.option(
+    "--bulk",
+    "bulk",
+    is_flag=True,
+    default=False,
+    help=s.bulk_help,
+)
+@click.option(
+    "--maintenance-work-mem",
+    "maintenance_work_mem",
+    type=click.IntRange(min=1),
+    default=512,
+    help=s.maintenance_work_mem_help,
+)
+@click.option(
+    "--maintenance-workers",
+    "maintenance_workers",
+    type=click.IntRange(min=0),
+    default=None,
+    help=s.maintenance_workers_help,
+)
+@click.option(
+    "--cluster-threshold",
+    "cluster_threshold",
+    type=click.FloatRange(min=0, max=1),
+    default=0.2,
+    help=s.cluster_threshold_help,
+)
+@click.option(
+    "--partition",
+    "partition",
+    type=click.Choice(list(PARTITION_KEYS)),
+    default=None,
+    help=s.partition_help,
+)
+@click.option(
+    "--resume",
+    "resume",
+    is_flag=True,
+    default=False,
+    help=s.resume_help,
+)
+@click.option(
+    "--update",
+    "update",
+    is_flag=True,
+    default=False,
+    help=s.update_help,
+)
+@click.option(
+    "--keep-templates",
+    "keep_templates",
+    is_flag=True,
+    default=False,
+    help=s.keep_templates_help,
+)
+@click.option(
+    "--storage",
+    "storage",
+    type=click.Choice(list(STORAGE_FORMATS)),
+    default="json",
+    help=s.storage_help,
+)
+@click.option(
+    "--offline",
+    "offline",
+    is_flag=True,
+    default=False,
+    help=s.offline_help,
+)
+@click.option(
+    "--extension-mirror",
+    "extension_mirror",
+    type=str,
+    default=None,
+    help=s.extension_mirror_help,
+)
+@click.option(
+    "--extension-ttl",
+    "extension_ttl",
+    type=click.FloatRange(min=0),
+    default=24,
+    help=s.extension_ttl_help,
+)
 def import_cj(
     filepath,
     host,
@@ -96,7 +204,22 @@ def import_cj(
     partial_indexed_attributes,
     ignore_repeated_file,
     overwrite,
-    transform
+    transform,
+    batch_size,
+    batch_memory,
+    jobs,
+    bulk,
+    maintenance_work_mem,
+    maintenance_workers,
+    cluster_threshold,
+    partition,
+    resume,
+    update,
+    keep_templates,
+    storage,
+    offline,
+    extension_mirror,
+    extension_ttl
 ):
     """Import CityJSONL files to a PostgreSQL database.
     Example of cli command:
@@ -115,7 +238,22 @@ def import_cj(
         partial_indexed_attributes,
         ignore_repeated_file,
         overwrite,
-        transform
+        transform,
+        batch_size=batch_size,
+        batch_memory=batch_memory,
+        jobs=jobs,
+        bulk=bulk,
+        maintenance_work_mem=maintenance_work_mem,
+        maintenance_workers=maintenance_workers,
+        cluster_threshold=cluster_threshold,
+        partition=partition,
+        resume=resume,
+        update=update,
+        keep_templates=keep_templates,
+        storage=storage,
+        offline=offline,
+        extension_mirror=extension_mirror,
+        extension_ttl=extension_ttl
     ) as imp:
         imp.run_import()
 
@@ -139,7 +277,16 @@ def import_cj(
               type=str,
               default="cj_export.jsonl",
               help=s.output_help)
-def export_cj(query, host, port, user, password, database, schema, output):
+@click.option("--itersize",
+              type=click.IntRange(min=1),
+              default=2000,
+              help=s.itersize_help)
+@click.option("--jobs", "-j",
+              type=click.IntRange(min=1),
+              default=1,
+              help=s.export_jobs_help)
+def export_cj(query, host, port, user, password, database, schema, output,
+              itersize, jobs):
     """Export a CityJSONL schema to a file.
  
        Example for exporting all the objects in a schema:
@@ -164,7 +311,9 @@ def export_cj(query, host, port, user, password, database, schema, output):
         conn,
         schema,
         query,
-        output_abs
+        output_abs,
+        itersize=itersize,
+        jobs=jobs
     ) as exp:
         exp.run_export()
     conn.close()
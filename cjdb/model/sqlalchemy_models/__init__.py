@@ -1,7 +1,7 @@
 from geoalchemy2 import Geometry
-from sqlalchemy import (Column, ForeignKey, Integer, String, UniqueConstraint,
-                        func)
-from sqlalchemy.dialects.postgresql import JSONB, TIMESTAMP
+from sqlalchemy import (BigInteger, Column, Float, ForeignKey, Integer,
+                        String, UniqueConstraint, func, select, text)
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TIMESTAMP
 from sqlalchemy.orm import declarative_base, relationship
 
 
@@ -31,6 +31,15 @@ class CjMetadataModel(BaseModel):
     started_at = Column(TIMESTAMP, default=func.now())
     finished_at = Column(TIMESTAMP)
     bbox = Column(Geometry("Polygon"))
+    # progress of the import, committed with every batch:
+    # the number of features and the position in the file after them
+    imported_features = Column(Integer, default=0)
+    imported_bytes = Column(BigInteger, default=0)
+    # hash of the imported_bytes first bytes of the file, to find
+    # out if the file changed before the import is resumed
+    imported_hash = Column(String)
+    # hash of the file content and of the SRIDs it was imported with
+    content_hash = Column(String)
     objects = relationship("CjObjectModel",
                            backref='cj_metadata',
                            passive_deletes=True)
@@ -48,6 +57,30 @@ class CjMetadataModel(BaseModel):
             return same_source_import
         return False
 
+    def get_unchanged_import(self, session):
+        """Returns a finished import of the same source file with the
+        same content and SRIDs, if any."""
+        if not self.content_hash:
+            return None
+        return (
+            session.query(CjMetadataModel)
+            .filter_by(source_file=self.source_file,
+                       content_hash=self.content_hash)
+            .filter(CjMetadataModel.finished_at.isnot(None))
+            .first()
+        )
+
+    def get_unfinished_import(self, session):
+        """Returns the last import of the same source file
+        that did not finish, if any."""
+        return (
+            session.query(CjMetadataModel)
+            .filter_by(source_file=self.source_file)
+            .filter(CjMetadataModel.finished_at.is_(None))
+            .order_by(CjMetadataModel.id.desc())
+            .first()
+        )
+
     def different_srid_meta(self, session):
         """Check if the CRS is consistent with previous imports."""
         return (
@@ -68,6 +101,13 @@ class CjObjectModel(BaseModel):
     attributes = Column(NullableJSONB())
     geometry = Column(NullableJSONB())
     ground_geometry = Column(Geometry("MultiPolygon"))
+    # vertices of the geometry in the compact storage format,
+    # quantized with the transform of the file (see modules.storage)
+    vertices = Column(ARRAY(Integer))
+    # 3D extent of the geometry: minx, miny, minz, maxx, maxy, maxz
+    extent = Column(ARRAY(Float))
+    # id of the CityJSONFeature the object was imported with
+    feature_id = Column(String)
     metadata_id_object_id_unique = UniqueConstraint(cj_metadata_id, object_id)
 
     @classmethod
@@ -96,17 +136,61 @@ class CjObjectModel(BaseModel):
         return type_mapping
 
     @classmethod
-    def get_max_id(cls, session) -> int:
-        max = session.query(func.max(cls.id)).scalar()
-        if max:
-            return max
-        else:
-            return 0
+    def lock_id_sequence(cls, conn):
+        """Takes the transaction level advisory lock that serializes
+        the id reservations on the table and returns the name and
+        state of the id sequence."""
+        table_name = f"{cls.__table__.schema}.{cls.__table__.name}"
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"),
+                     {"name": table_name})
+        sequence = conn.execute(
+            text("SELECT pg_get_serial_sequence(:name, 'id')"),
+            {"name": table_name}
+        ).scalar()
+        last_value, is_called = conn.execute(
+            text(f"SELECT last_value, is_called FROM {sequence}")
+        ).one()
+        return sequence, last_value, is_called
+
+    @classmethod
+    def reserve_ids(cls, engine, count) -> int:
+        """Reserves a block of ids from the id sequence of the table,
+        so that importers running at the same time, in the same or
+        in other processes, never give out the same id.
+        The reserved ids are the ones following the returned id."""
+        with engine.begin() as conn:
+            sequence, last_value, is_called = cls.lock_id_sequence(conn)
+            # the sequence is not used for the inserts themselves, so
+            # it can be behind the ids of schemas from older versions
+            last_reserved = last_value if is_called else last_value - 1
+            max_id = conn.execute(select(func.max(cls.id))).scalar() or 0
+            start = max(last_reserved, max_id)
+            conn.execute(text("SELECT setval(:sequence, :value)"),
+                         {"sequence": sequence, "value": start + count})
+        return start
+
+    @classmethod
+    def release_ids(cls, engine, last_used, last_reserved) -> None:
+        """Gives the unused end of the last reserved block back to the
+        id sequence, if nobody else reserved ids in the meantime."""
+        with engine.begin() as conn:
+            sequence, last_value, is_called = cls.lock_id_sequence(conn)
+            if is_called and last_value == last_reserved:
+                conn.execute(
+                    text("SELECT setval(:sequence, :value, :is_called)"),
+                    {"sequence": sequence,
+                     "value": max(last_used, 1),
+                     "is_called": last_used > 0}
+                )
 
 
 class CityObjectRelationshipModel(BaseModel):
     __tablename__ = "city_object_relationships"
     __table_args__ = {"schema": "cjdb"}
+    # parents and children always come from the same file, this
+    # allows partitioning the relationships like the city objects
+    cj_metadata_id = Column(Integer, ForeignKey(CjMetadataModel.id,
+                                                ondelete='CASCADE'))
     parent_id = Column(Integer, ForeignKey(CjObjectModel.id,
                                            ondelete='CASCADE'))
     child_id = Column(Integer, ForeignKey(CjObjectModel.id,
@@ -120,3 +204,26 @@ class CityObjectRelationshipModel(BaseModel):
                          post_update=True)
 
     parent_child_unique = UniqueConstraint(parent_id, child_id)
+
+
+class CjFeatureModel(BaseModel):
+    """The CityJSONFeatures of the imported files with a hash of
+    their content, to only apply the changed features when a file
+    is imported again with --update."""
+    __tablename__ = "cj_feature"
+    __table_args__ = {"schema": "cjdb"}
+    cj_metadata_id = Column(Integer, ForeignKey(CjMetadataModel.id,
+                                                ondelete='CASCADE'))
+    feature_id = Column(String, nullable=False)
+    hash = Column(String, nullable=False)
+
+    metadata_id_feature_id_unique = UniqueConstraint(cj_metadata_id,
+                                                     feature_id)
+
+    @classmethod
+    def get_hashes(cls, session, cj_metadata_id) -> dict:
+        """Returns the feature ids of an imported file by their hash."""
+        rows = session.query(cls.hash, cls.feature_id).filter_by(
+            cj_metadata_id=cj_metadata_id
+        )
+        return {feature_hash: feature_id for feature_hash, feature_id in rows}
@@ -1,7 +1,8 @@
-from pyproj import CRS, datadir
+from pyproj import datadir
 from pyproj.transformer import TransformerGroup
 
 from cjdb.logger import logger
+from cjdb.modules.geometric import get_crs
 
 
 def check_root_properties(found_extra_properties, defined_extra_properties):
@@ -28,8 +29,8 @@ def check_object_type(checked_type, allowed_types, extended_types):
 # check if reprojection possible
 # logs warnings, but doesn't stop the import
 def check_reprojection(source_srid, target_srid):
-    source_proj = CRS.from_epsg(source_srid)
-    target_proj = CRS.from_epsg(target_srid)
+    source_proj = get_crs(source_srid)
+    target_proj = get_crs(target_srid)
 
     if len(target_proj.axis_info) < 3:
         logger.warning(
@@ -0,0 +1,26 @@
+"""JSON encoding and decoding of features, metadata and attributes.
+orjson is used when it is installed, as it is several times faster
+than the json module of the standard library, which is the fallback.
+Both produce compact JSON, so the output only differs in the way some
+floats are written (e.g. 1e-05 and 1e-5)."""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Decodes a JSON document given as bytes or str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    """Encodes an object as compact JSON text."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj, separators=(",", ":"))
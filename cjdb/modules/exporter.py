@@ -1,31 +1,50 @@
 import copy
-import json
 import sys
 import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, islice
+from operator import itemgetter
 
+import psycopg2
 from psycopg2 import sql
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, register_default_jsonb
 
 from cjdb.logger import logger
-from typing import Dict
+from cjdb.modules.codec import dumps, loads
+from cjdb.modules.geometric import get_extent, get_vertices_extent
+from cjdb.modules.storage import decode_vertices, requantize_vertices
+from typing import Dict, Iterator, List
 import io
 
+# number of features assembled at once by a worker process
+FEATURES_PER_TASK = 256
+# number of tasks per worker that are scheduled ahead
+TASKS_IN_FLIGHT = 4
+
 
 # exporter class
 class Exporter:
-    def __init__(self, connection, schema, sqlquery, output):
+    def __init__(self, connection, schema, sqlquery, output, itersize=2000,
+                 jobs=1):
         self.connection = connection
         self.schema = schema
-        if not sqlquery:
-            self.sqlquery = f"""SELECT cjo.object_id
-                                FROM {self.schema}.city_object cjo"""
-        else:
-            self.sqlquery = sqlquery
+        # query of the object ids to export, all the objects if None
+        self.sqlquery = sqlquery or None
         self.output = output
+        # number of rows fetched at once from the server side cursors
+        self.itersize = itersize
+        # number of processes assembling and serializing the features
+        self.jobs = jobs
         self.bboxmin = [0.0, 0.0, 0.0]
-        self.relationships = {}
-        self.city_objects = set()
-        self.data = {}
+        # transforms of the imported files, to decode the geometries
+        # stored in the compact format
+        self.transforms = {}
+        # geometry templates of the unexpanded geometry instances,
+        # merged from their files, and the index of the first
+        # template of each file in them
+        self.geometry_templates = None
+        self.template_offsets = {}
 
     def __enter__(self):
         return self
@@ -33,41 +52,88 @@ class Exporter:
     def __exit__(self, exc_type, exc_value, traceback):
         pass
 
-    def get_city_objects_and_relationships(self) -> Dict:
-        sql_query = f"""
-            WITH only_parents AS (
-                SELECT cjo.id, cjo.object_id
+    def select_roots(self) -> int:
+        """Stores the ids of the objects without parent selected by the
+        query in a temporary table, which the export queries join.
+        The query is run once, and the bbox and the features are read
+        from the same selection. Returns the number of objects."""
+        condition = ""
+        if self.sqlquery:
+            condition = f'AND cjo."object_id" IN ({self.sqlquery})'
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TEMPORARY TABLE cjdb_export_roots
+                ON COMMIT DROP AS
+                SELECT cjo.id
                 FROM {self.schema}.city_object cjo
-                LEFT JOIN {self.schema}.city_object_relationships f
-                ON cjo.id = f.child_id
-                WHERE f.child_id IS NULL)
-            SELECT
-                cjo.id, cjo.object_id, array_agg(f.child_id) as children
-            FROM
-                {self.schema}.city_object cjo
-            LEFT JOIN
-                {self.schema}.city_object_relationships  f
-            ON cjo.id  = f.parent_id
-            JOIN
-                only_parents op
-            ON cjo.id = op.id
-            WHERE cjo."object_id" IN ({self.sqlquery})
-            GROUP BY
-                cjo.id, cjo.object_id;
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM {self.schema}.city_object_relationships f
+                    WHERE f.child_id = cjo.id)
+                {condition}""")
+            count = cursor.rowcount
+            cursor.execute(
+                "ALTER TABLE cjdb_export_roots ADD PRIMARY KEY (id)"
+            )
+            cursor.execute("ANALYZE cjdb_export_roots")
+        return count
+
+    def get_roots(self, root_ids=False) -> str:
+        """Returns the relation of the selected objects without parent.
+        With root_ids, they are taken from the root_ids parameter
+        instead of the temporary table, which only the connection that
+        created it can read."""
+        if root_ids:
+            return "(SELECT unnest(%(root_ids)s::integer[]) AS id)"
+        return "cjdb_export_roots"
+
+    def get_feature_objects(self, root_ids=False) -> str:
+        """Returns a query of the objects to export: the selected
+        objects without parent, with all their descendants.
+        Every object has the id of the object it is exported with
+        (root_id) and the parent it was reached from."""
+        return f"""
+            WITH RECURSIVE feature_objects AS (
+                SELECT r.id AS root_id, r.id,
+                       NULL::integer AS parent_id, 0 AS depth
+                FROM {self.get_roots(root_ids)} r
+                UNION ALL
+                SELECT fo.root_id, f.child_id, f.parent_id, fo.depth + 1
+                FROM feature_objects fo
+                JOIN {self.schema}.city_object_relationships f
+                ON f.parent_id = fo.id)
             """
 
-        with self.connection.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute(sql_query)
-            rows = cursor.fetchall()
-        if len(rows) == 0:
-            logger.warning("No data from the input ids.")
-            sys.exit(1)
+    def stream(self, query, name, params=None) -> Iterator:
+        """Yields the rows of a query from a server side cursor,
+        which fetches itersize rows at a time."""
+        with self.connection.cursor(name=name,
+                                    cursor_factory=DictCursor) as cursor:
+            cursor.itersize = self.itersize
+            # decode the jsonb columns with the same codec as the output
+            register_default_jsonb(cursor, loads=loads)
+            cursor.execute(query, params)
+            yield from cursor
 
-        for r in rows:
-            self.city_objects.add(r['id'])
-            if r['children'][0]:
-                self.city_objects.update(r['children'])
-            self.relationships[r['id']] = r['children']
+    def get_transforms(self) -> None:
+        with self.connection.cursor() as cursor:
+            register_default_jsonb(cursor, loads=loads)
+            cursor.execute(
+                sql.SQL("SELECT m.id, m.transform FROM {}.cj_metadata m")
+                .format(sql.Identifier(self.schema))
+            )
+            self.transforms = dict(cursor.fetchall())
+
+    def get_columns(self) -> set:
+        """Returns the columns of the city objects, as schemas
+        created by older versions miss some of them."""
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = %s AND table_name = 'city_object'",
+                (self.schema,)
+            )
+            return {row[0] for row in cursor.fetchall()}
 
     def get_metadata(self) -> Dict:
         # first line of the CityJSONL stream with some metadata
@@ -100,8 +166,11 @@ class Exporter:
             ]
         else:
             metadata["metadata"]["referenceSystem"] = "https://www.opengis.net/def/crs/EPSG/0/" + str(meta1["srid"])  # noqa
-        
-        # TODO: add geometry-template from all imported files or select only
+
+        if self.geometry_templates:
+            metadata["geometry-templates"] = self.geometry_templates
+
+        # TODO: add extensions from all imported files or select only
         #       the ones relevant?
         #       We could iterate over the ids and fetch the ones having '+'
         #       but that's tricky
@@ -109,77 +178,196 @@ class Exporter:
         #       though
         # TODO: add extra-properties? Tricky to know which ones to be honest,
         #       maybe a flag?
-        
-        # fetch in memory *all* we need, won't work for super large datasets
+
         metadata["transform"]["translate"] = self.bboxmin
-        metadata = json.dumps(metadata, separators=(',', ':'))
+        metadata = dumps(metadata)
         return metadata
     
-    def get_data(self):
-        self.get_city_objects_and_relationships()
-        with self.connection.cursor(cursor_factory=DictCursor) as cursor:
-            sql = f"""SELECT * FROM {self.schema}.city_object co"""
-            if self.city_objects:
-                sql = sql + f""" WHERE co.id IN
-                     ({ str(self.city_objects).strip('{').strip('}')});"""
-                      
-            cursor.execute(sql)
+    def get_geometry_templates(self):
+        """Fetches the geometry templates of the files that have
+        geometry instances stored unexpanded (import --keep-templates)."""
+        with self.connection.cursor() as cursor:
+            register_default_jsonb(cursor, loads=loads)
+            cursor.execute(
+                sql.SQL("""SELECT m.id, m.geometry_templates
+                           FROM {schema}.cj_metadata m
+                           WHERE m.geometry_templates IS NOT NULL
+                           AND m.id IN (
+                               SELECT cjo.cj_metadata_id
+                               FROM {schema}.city_object cjo
+                               WHERE cjo.geometry @> %s)
+                           ORDER BY m.id""")
+                .format(schema=sql.Identifier(self.schema)),
+                (dumps([{"type": "GeometryInstance"}]),)
+            )
             rows = cursor.fetchall()
-        for r in rows:
-            self.data[r['id']] = r
-        self.set_min_bbox()
+        self.geometry_templates, self.template_offsets = \
+            merge_geometry_templates(rows)
+
+    def get_features(self, root_ids=None) -> Iterator[str]:
+        """Yields the features to export, or the features of root_ids.
+        The objects of a feature arrive one after the other, so every
+        feature is written as soon as its objects have been fetched.
+        The descendants are found per object without parent, in the
+        order of the ids of those, which the primary key of the
+        temporary table gives without sorting the fetched rows. Only
+        the objects of a feature are sorted, when it is written."""
+        query = f"""
+            SELECT r.id AS root_id, fo.parent_id, fo.depth, co.*
+            FROM {self.get_roots(root_ids is not None)} r
+            CROSS JOIN LATERAL (
+                WITH RECURSIVE feature_objects AS (
+                    SELECT r.id, NULL::integer AS parent_id, 0 AS depth
+                    UNION ALL
+                    SELECT f.child_id, f.parent_id, fo.depth + 1
+                    FROM feature_objects fo
+                    JOIN {self.schema}.city_object_relationships f
+                    ON f.parent_id = fo.id)
+                SELECT * FROM feature_objects) fo
+            JOIN {self.schema}.city_object co
+            ON co.id = fo.id
+            ORDER BY r.id"""
+        params = None
+        if root_ids is not None:
+            params = {"root_ids": root_ids}
+        rows = self.stream(query, "cjdb_export_features", params)
+        for root_id, feature_rows in groupby(rows, key=itemgetter("root_id")):
+            data = {}
+            relationships = {}
+            for r in sorted(feature_rows, key=itemgetter("depth", "id")):
+                data[r["id"]] = r
+                if r["parent_id"] is not None:
+                    relationships.setdefault(r["parent_id"], []).append(
+                        r["id"]
+                    )
+            yield write_cjf(root_id,
+                            relationships.get(root_id, []),
+                            data,
+                            relationships,
+                            self.bboxmin,
+                            self.template_offsets,
+                            self.transforms)
 
-    def get_features(self):
-        feature_list = []
-        for parent, children in self.relationships.items():
-            feature = write_cjf(parent,
-                                children,
-                                self.data,
-                                self.relationships,
-                                self.bboxmin)
-            feature_list.append(feature)
-        return feature_list
-        
     def run_export(self) -> None:
         logger.info("Exporting from schema %s", self.schema)
-        f_out = open(self.output, "w")
-
-        self.get_data()
-
-        metadata = self.get_metadata()
-        print(metadata, file=f_out)
+        # the bbox and the features are read from the same snapshot
+        self.connection.rollback()
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+            )
+        if self.select_roots() == 0:
+            logger.warning("No data from the input ids.")
+            sys.exit(1)
+        self.get_transforms()
+        self.set_min_bbox()
+        self.get_geometry_templates()
 
-        features = self.get_features()
-        for feature in features:
-            print(feature, file=f_out)
+        with open(self.output, "w") as f_out:
+            metadata = self.get_metadata()
+            print(metadata, file=f_out)
 
-        f_out.close()
+            if self.jobs > 1:
+                features = self.get_features_in_parallel()
+            else:
+                features = self.get_features()
+            for feature in features:
+                print(feature, file=f_out)
+        self.connection.commit()
         logger.info("Schema exported in %s", self.output)
 
+    def get_features_in_parallel(self) -> Iterator[str]:
+        """Yields the features to export, assembled and serialized by
+        a pool of worker processes. Every worker reads from its own
+        connection, in a transaction that imports the snapshot of this
+        one, so all of them see the same data. The features are sent
+        to the workers in chunks of ids without parent, in the order
+        of the ids, and yielded in that order too, so the output is the
+        same as with a single process."""
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT pg_export_snapshot()")
+            snapshot = cursor.fetchone()[0]
+        state = {
+            "schema": self.schema,
+            "itersize": self.itersize,
+            "bboxmin": self.bboxmin,
+            "transforms": self.transforms,
+            "template_offsets": self.template_offsets,
+        }
+        root_ids = (row[0] for row in self.stream(
+            "SELECT id FROM cjdb_export_roots ORDER BY id",
+            "cjdb_export_root_ids"
+        ))
+        logger.info("Exporting the features with %s processes", self.jobs)
+        with ProcessPoolExecutor(
+            max_workers=self.jobs,
+            initializer=init_export_worker,
+            initargs=(get_connection_parameters(self.connection),
+                      snapshot,
+                      state)
+        ) as executor:
+            pending = deque()
+            while True:
+                while len(pending) < self.jobs * TASKS_IN_FLIGHT:
+                    chunk = list(islice(root_ids, FEATURES_PER_TASK))
+                    if not chunk:
+                        break
+                    pending.append(
+                        executor.submit(get_features_in_worker, chunk)
+                    )
+                if not pending:
+                    break
+                yield from pending.popleft().result()
+
     def set_min_bbox(self):
+        """Finds the minimum corner of the exported geometries, which
+        is the translate of the output. It is computed in the database
+        from the extents of the objects. Only the geometries of the
+        objects imported without an extent, by older versions, are
+        read."""
+        columns = self.get_columns()
         bboxmin = [sys.float_info.max, sys.float_info.max, sys.float_info.max]
-        for object_id, members in self.data.items():
-            if members["geometry"] is not None:
-                for g in members["geometry"]:
-                    if g["type"] == "Solid":
-                        for shell in g["boundaries"]:
-                            for surface in shell:
-                                for ring in surface:
-                                    for vertex in ring:
-                                        for i in range(3):
-                                            if vertex[i] < bboxmin[i]:
-                                                bboxmin[i] = vertex[i]
-                    elif g["type"] == "MultiSurface" \
-                                      or g["type"] == "CompositeSurface":
-                        for surface in g["boundaries"]:
-                            for ring in surface:
-                                for vertex in ring:
-                                    for i in range(3):
-                                        if vertex[i] < bboxmin[i]:
-                                            bboxmin[i] = vertex[i]
-                    else:
-                        # TODO: implement for MultiSolid
-                        logger.warning("GEOMETRY NOT SUPPORTED YET")
+        if "extent" in columns:
+            with self.connection.cursor() as cursor:
+                cursor.execute(self.get_feature_objects() + f"""
+                    SELECT min(co.extent[1]), min(co.extent[2]),
+                           min(co.extent[3]),
+                           count(*) FILTER (WHERE co.extent IS NULL
+                                            AND co.geometry IS NOT NULL)
+                    FROM feature_objects fo
+                    JOIN {self.schema}.city_object co
+                    ON co.id = fo.id""")
+                *minimum, missing = cursor.fetchone()
+            for i, value in enumerate(minimum):
+                if value is not None:
+                    bboxmin[i] = value
+            if not missing:
+                self.bboxmin = bboxmin
+                return
+            condition = "co.extent IS NULL AND co.geometry IS NOT NULL"
+        else:
+            condition = "co.geometry IS NOT NULL"
+
+        vertices = "co.vertices"
+        if "vertices" not in columns:
+            vertices = "NULL::integer[] AS vertices"
+        query = self.get_feature_objects() + f"""
+            SELECT co.cj_metadata_id, co.geometry, {vertices}
+            FROM feature_objects fo
+            JOIN {self.schema}.city_object co
+            ON co.id = fo.id
+            WHERE {condition}"""
+        for members in self.stream(query, "cjdb_export_bbox"):
+            if members["vertices"] is not None:
+                # the vertices of the compact geometries are enough
+                extent = get_vertices_extent(decode_vertices(
+                    members["vertices"],
+                    self.transforms[members["cj_metadata_id"]]
+                ))
+            else:
+                extent = get_extent(members["geometry"])
+            if extent is not None:
+                bboxmin = [min(a, b) for a, b in zip(bboxmin, extent)]
         self.bboxmin = bboxmin
 
     def remove_duplicate_vertices(self, j):
@@ -216,7 +404,70 @@ class Exporter:
         return j
 
 
-def write_cjf(parent, children, data, relationships, bboxmin):
+def get_connection_parameters(connection) -> Dict:
+    """Returns the parameters to open another connection
+    like the given one, e.g. in a worker process."""
+    parameters = dict(connection.info.dsn_parameters)
+    if connection.info.password:
+        parameters["password"] = connection.info.password
+    return parameters
+
+
+# exporter of the worker process, set once when the worker starts
+_worker_exporter = None
+
+
+def init_export_worker(parameters, snapshot, state) -> None:
+    """Connects a worker process to the database, in a transaction
+    that sees the snapshot exported by the main process."""
+    global _worker_exporter
+    connection = psycopg2.connect(**parameters)
+    with connection.cursor() as cursor:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+    _worker_exporter = Exporter(connection, state["schema"], None, None,
+                                itersize=state["itersize"])
+    _worker_exporter.bboxmin = state["bboxmin"]
+    _worker_exporter.transforms = state["transforms"]
+    _worker_exporter.template_offsets = state["template_offsets"]
+
+
+def get_features_in_worker(root_ids: List[int]) -> List[str]:
+    return list(_worker_exporter.get_features(root_ids))
+
+
+def merge_geometry_templates(rows):
+    """Merges the geometry templates of several files into one
+    geometry-templates object. Returns it with the index of the first
+    template of every file, by cj_metadata id."""
+    if not rows:
+        return None, {}
+    merged = {"templates": [], "vertices-templates": []}
+    offsets = {}
+    for cj_metadata_id, geometry_templates in rows:
+        offsets[cj_metadata_id] = len(merged["templates"])
+        vertex_offset = len(merged["vertices-templates"])
+        for template in geometry_templates["templates"]:
+            template = dict(template)
+            template["boundaries"] = offset_indices(template["boundaries"],
+                                                    vertex_offset)
+            merged["templates"].append(template)
+        merged["vertices-templates"].extend(
+            geometry_templates["vertices-templates"]
+        )
+    return merged, offsets
+
+
+def offset_indices(boundaries, offset):
+    return [
+        offset_indices(b, offset) if isinstance(b, list) else b + offset
+        for b in boundaries
+    ]
+
+
+def write_cjf(parent, children, data, relationships, bboxmin,
+              template_offsets=None, transforms=None):
+    template_offsets = template_offsets or {}
     poid = data[parent]["object_id"]
     j = {}
     j["type"] = "CityJSONFeature"
@@ -229,8 +480,8 @@ def write_cjf(parent, children, data, relationships, bboxmin):
             data[parent]["attributes"]
     # parent first
     vertices = []
-    g2, vs = reference_vertices_in_cjf(
-        data[parent]["geometry"], 3, bboxmin, len(vertices)
+    g2, vs = reference_object_in_cjf(
+        data[parent], bboxmin, len(vertices), template_offsets, transforms
     )
     vertices.extend(vs)
     if g2 is not None:
@@ -242,17 +493,24 @@ def write_cjf(parent, children, data, relationships, bboxmin):
     while len(ls_parents_children) > 0:
         pc = ls_parents_children.pop()
         j, vertices = add_child_to_cjf(
-            j, pc[0], pc[1], vertices, bboxmin, data
+            j, pc[0], pc[1], vertices, bboxmin, data, template_offsets,
+            transforms
         )
-        # ls_parents_children.extend(new_pc)
+        # the children of the child are added too
         if pc[1] in relationships:
-            ls_parents_children.extend(relationships[pc[1]].children)
+            ls_parents_children.extend(
+                (pc[1], grandchild)
+                for grandchild in relationships[pc[1]]
+                if grandchild is not None
+            )
     j["vertices"] = vertices
     j = remove_duplicate_vertices(j)
-    return json.dumps(j, separators=(",", ":"))
+    return dumps(j)
 
 
-def add_child_to_cjf(j, parent_id, child_id, vertices, bboxmin, relationships):
+def add_child_to_cjf(j, parent_id, child_id, vertices, bboxmin, relationships,
+                     template_offsets=None, transforms=None):
+    template_offsets = template_offsets or {}
     poid = relationships[parent_id]["object_id"]
     coid = relationships[child_id]["object_id"]
     if "children" not in j["CityObjects"][poid]:
@@ -263,11 +521,10 @@ def add_child_to_cjf(j, parent_id, child_id, vertices, bboxmin, relationships):
     if "attributes" in relationships[child_id] and relationships[child_id]["attributes"]:
         j["CityObjects"][coid]["attributes"] = relationships[child_id]["attributes"]
     j["CityObjects"][coid]["parents"] = [poid]
-    g2, vs = \
-        reference_vertices_in_cjf(relationships[child_id]["geometry"],
-                                  3,
-                                  bboxmin,
-                                  len(vertices))
+    g2, vs = reference_object_in_cjf(
+        relationships[child_id], bboxmin, len(vertices), template_offsets,
+        transforms
+    )
     vertices.extend(vs)
     if g2 is not None:
         j["CityObjects"][coid]["geometry"] = g2
@@ -308,7 +565,39 @@ def remove_duplicate_vertices(j):
     return j
 
 
-def reference_vertices_in_cjf(gs, imp_digits, translate, offset=0):
+def reference_object_in_cjf(row, bboxmin, offset, template_offsets,
+                            transforms):
+    template_offset = template_offsets.get(row["cj_metadata_id"], 0)
+    if row.get("vertices") is not None:
+        # geometry stored in the compact format (import --storage)
+        return reference_compact_vertices_in_cjf(
+            row["geometry"], row["vertices"],
+            transforms[row["cj_metadata_id"]], 3, bboxmin, offset,
+            template_offset
+        )
+    return reference_vertices_in_cjf(row["geometry"], 3, bboxmin, offset,
+                                     template_offset)
+
+
+def reference_compact_vertices_in_cjf(gs, vertices, transform, imp_digits,
+                                      translate, offset=0, template_offset=0):
+    """Like reference_vertices_in_cjf, for a geometry stored in the
+    compact format: its boundaries already hold vertex indices, and its
+    quantized vertices are mapped to the transform of the export."""
+    if gs is None:
+        return (gs, [])
+    gs2 = []
+    for g in gs:
+        g2 = dict(g, boundaries=offset_indices(g["boundaries"], offset))
+        if g["type"] == "GeometryInstance":
+            g2["template"] = g["template"] + template_offset
+        gs2.append(g2)
+    scale = [10 ** -imp_digits] * 3
+    return (gs2, requantize_vertices(vertices, transform, scale, translate))
+
+
+def reference_vertices_in_cjf(gs, imp_digits, translate, offset=0,
+                              template_offset=0):
     vertices = []
     if gs is None:
         return (gs, vertices)
@@ -345,5 +634,17 @@ def reference_vertices_in_cjf(gs, imp_digits, translate, offset=0):
                                 .replace(".", "")
                             )
                         vertices.append(v)
+        elif g["type"] == "GeometryInstance":
+            # the anchor point is the only vertex of an instance
+            for k, vertex in enumerate(g["boundaries"]):
+                gs2[h]["boundaries"][k] = offset
+                offset += 1
+                v = [0.0, 0.0, 0.0]
+                for r in range(3):
+                    v[r] = int(
+                        (p % (vertex[r] - translate[r])).replace(".", "")
+                    )
+                vertices.append(v)
+            gs2[h]["template"] = g["template"] + template_offset
         # TODO: MultiSolid
     return (gs2, vertices)
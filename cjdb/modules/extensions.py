@@ -1,33 +1,201 @@
+import hashlib
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import unquote, urlparse
+from urllib.request import url2pathname
 
 import requests
 
 from cjdb.logger import logger
 
+# number of extension schemas downloaded at the same time
+MAX_DOWNLOADS = 8
+
+
+def get_cache_dir() -> Path:
+    """Returns the directory of the extension cache,
+    $CJDB_CACHE_DIR or ~/.cache/cjdb."""
+    cache_dir = os.environ.get("CJDB_CACHE_DIR")
+    if cache_dir:
+        return Path(cache_dir).expanduser()
+    return Path.home() / ".cache" / "cjdb"
+
+
+def url_to_path(url: str) -> Optional[Path]:
+    """Returns the local path of a file:// url or of a local path,
+    or None for other urls."""
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return Path(url2pathname(unquote(parsed.path)))
+    if not parsed.scheme or len(parsed.scheme) == 1:
+        # no scheme or a Windows drive letter
+        return Path(url)
+    return None
+
+
+class ExtensionCache:
+    """Resolves the schemas of the CityJSON extensions by their url.
+
+    The schemas are kept on disk, shared by all imports, and are
+    content addressed: every schema is stored once under the hash of
+    its content, and every url refers to the hash of its last
+    download. A schema is downloaded again when its entry is older
+    than ttl hours. When the download fails, an expired schema is
+    still used.
+
+    With a mirror (a local directory or a file:// url), the schemas
+    are read from the file of the mirror with the name of their url,
+    instead of being downloaded. Offline, only the mirror and the
+    cache are used."""
+    def __init__(self, offline=False, mirror=None, ttl=24, cache_dir=None):
+        self.offline = offline
+        self.mirror = url_to_path(mirror) if mirror else None
+        self.ttl = ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else get_cache_dir()
+        # schemas already resolved with these settings, by url
+        self.definitions = {}
+        self.definitions_lock = threading.Lock()
+
+    def get_definitions(self, urls) -> Dict[str, Optional[str]]:
+        """Returns the schema of every url as text, or None if it
+        could not be resolved. The urls that are not known yet are
+        resolved concurrently."""
+        urls = list(dict.fromkeys(urls))
+        with self.definitions_lock:
+            missing = [url for url in urls if url not in self.definitions]
+        if missing:
+            workers = min(MAX_DOWNLOADS, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                resolved = executor.map(self.resolve, missing)
+                # the urls that failed are tried again by the next file
+                resolved = {url: definition
+                            for url, definition in zip(missing, resolved)
+                            if definition is not None}
+            with self.definitions_lock:
+                self.definitions.update(resolved)
+        with self.definitions_lock:
+            return {url: self.definitions.get(url) for url in urls}
+
+    def resolve(self, url) -> Optional[str]:
+        local_path = url_to_path(url)
+        if local_path is not None:
+            return self.read_file(local_path, url)
+        if self.mirror is not None:
+            mirror_path = self.mirror / Path(urlparse(url).path).name
+            if mirror_path.is_file():
+                return self.read_file(mirror_path, url)
+
+        cached, fetched_at = self.load(url)
+        expired = fetched_at is None or \
+            time.time() - fetched_at > self.ttl * 3600
+        if cached is not None and (not expired or self.offline):
+            return cached
+        if self.offline:
+            logger.error("Extension url: %s is not in the cache "
+                         "and cannot be downloaded offline", url)
+            return None
+
+        definition = self.download(url)
+        if definition is None:
+            if cached is not None:
+                logger.warning("Using the expired cached schema "
+                               "of the extension url: %s", url)
+            return cached
+        self.store(url, definition)
+        return definition
+
+    def read_file(self, path, url) -> Optional[str]:
+        try:
+            return path.read_text(encoding="utf-8")
+        except OSError as e:
+            logger.error("Extension url: %s could not be read: %s", url, e)
+            return None
+
+    def download(self, url) -> Optional[str]:
+        try:
+            resp = requests.get(url, timeout=10)
+        except Exception as e:
+            logger.error(e)
+            return None
+        if resp.status_code != 200:
+            logger.error("Extension url: %s did not return a "
+                         "correct response", url)
+            return None
+        return resp.text
+
+    def url_entry(self, url) -> Path:
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return self.cache_dir / "extensions" / "urls" / f"{name}.json"
+
+    def object_path(self, content_hash) -> Path:
+        return self.cache_dir / "extensions" / "objects" / \
+            f"{content_hash}.json"
+
+    def load(self, url):
+        """Returns the cached schema of a url and the time it was
+        downloaded, or (None, None)."""
+        try:
+            entry = json.loads(self.url_entry(url).read_text())
+            definition = self.object_path(entry["hash"]).read_text(
+                encoding="utf-8")
+            fetched_at = entry["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            return None, None
+        return definition, fetched_at
+
+    def store(self, url, definition) -> None:
+        """Adds a schema to the cache. The files are written under
+        a temporary name and then renamed, so that imports running
+        at the same time never read a partial file."""
+        content_hash = hashlib.sha256(definition.encode()).hexdigest()
+        entry = {"url": url, "hash": content_hash, "fetched_at": time.time()}
+        try:
+            object_path = self.object_path(content_hash)
+            if not object_path.exists():
+                write_atomic(object_path, definition)
+            write_atomic(self.url_entry(url), json.dumps(entry))
+        except OSError as e:
+            logger.warning("The extension cache %s is not writable: %s",
+                           self.cache_dir, e)
+
+
+def write_atomic(path, content) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}."
+                              f"{threading.get_ident()}.tmp")
+    tmp_path.write_text(content, encoding="utf-8")
+    os.replace(tmp_path, path)
+
 
 class ExtensionHandler:
-    def __init__(self, extensions):
+    def __init__(self, extensions, cache=None):
         self.full_definitions = {}
         self.extra_root_properties = []
         self.extra_attributes = {}
         self.extra_city_objects = []
+        self.cache = cache or ExtensionCache()
 
         if extensions:
             self.get_extensions(extensions)
 
     def get_extensions(self, extensions):
+        # the schemas of all the extensions are resolved at once
+        definitions = self.cache.get_definitions(
+            content["url"] for content in extensions.values()
+            if content.get("url")
+        )
         for ext_name, content in extensions.items():
             url = content.get("url")
             if url:
-                try:
-                    resp = requests.get(url, timeout=10)
-                except Exception as e:
-                    logger.error(e)
-                    resp = None
-
-                if resp and resp.status_code == 200:
+                definition = definitions[url]
+                if definition is not None:
                     try:
-                        ext_definition = json.loads(resp.text)
+                        ext_definition = json.loads(definition)
                         self.full_definitions[ext_name] = ext_definition
                     except ValueError as e:
                         logger.error(
@@ -1,17 +1,22 @@
 import copy
-from statistics import mean
-from typing import Any, Dict, List, Optional, Union
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
-from cjio.geom_help import get_normal_newell
+import shapely
 from pyproj import CRS, Transformer
 from shapely import force_2d
-from shapely.geometry import MultiPolygon, Point, Polygon
+from shapely.geometry import MultiPolygon, Polygon
 from shapely.ops import unary_union
 
 from cjdb.logger import logger
 from cjdb.modules.exceptions import InvalidLodException
 
+# number of transformed geometry templates kept by a TemplateResolver
+TEMPLATE_CACHE_SIZE = 1024
+
 
 # get srid from a CRS string definition
 def get_srid(crs):
@@ -31,100 +36,243 @@ def transform_vertex(vertex, transform):
     return new_v
 
 
-def transform_with_rotation(vertex, transform):
-    # matrix multiplication as in https://www.cityjson.org/dev/geom-templates/
-    homo_vertex = np.array([vertex + [1]]).T
-    t_matrix = np.reshape(transform, (4, 4))
+def transform_vertices(vertices, transform) -> np.ndarray:
+    """Applies the CityJSON transform to all the vertices of
+    a CityJSONFeature at once. Returns an (n, 3) float array."""
+    array = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    return array * transform["scale"] + transform["translate"]
 
-    transformed_vertex = np.dot(t_matrix, homo_vertex)
-    return list(transformed_vertex.T[0])[:-1]
 
+@lru_cache(maxsize=None)
+def get_crs(srid) -> CRS:
+    return CRS.from_epsg(srid)
 
-def reproject_vertex_list(vertices, srid_from, srid_to):
-    source_proj = CRS.from_epsg(srid_from)
-    target_proj = CRS.from_epsg(srid_to)
 
-    # prepare transformer from crs to crs
-    transformer = Transformer.from_crs(source_proj,
-                                       target_proj,
-                                       always_xy=True)
+@lru_cache(maxsize=None)
+def get_transformer(srid_from, srid_to) -> Transformer:
+    """Returns the transformer from crs to crs. Creating a transformer
+    is expensive, so one is kept per (source, target) SRID pair for the
+    whole run of the process."""
+    return Transformer.from_crs(get_crs(srid_from),
+                                get_crs(srid_to),
+                                always_xy=True)
 
-    # transform all the coordinates
-    reprojected_xyz = transformer.transform(*zip(*vertices))
-    reprojected_xyz = [list(i) for i in zip(*reprojected_xyz)]
 
-    return reprojected_xyz
+def reproject_vertices(vertices: np.ndarray,
+                       srid_from, srid_to) -> np.ndarray:
+    """Reprojects an (n, 3) array of vertices."""
+    transformer = get_transformer(srid_from, srid_to)
+    if len(vertices) == 1:
+        # pyproj transforms a single vertex as scalars, which
+        # a one element array would be converted to implicitly
+        x, y, z = transformer.transform(*vertices[0].tolist())
+    else:
+        x, y, z = transformer.transform(vertices[:, 0],
+                                        vertices[:, 1],
+                                        vertices[:, 2])
+    return np.column_stack((np.atleast_1d(x),
+                            np.atleast_1d(y),
+                            np.atleast_1d(z)))
+
+
+def reproject_vertex_list(vertices, srid_from, srid_to):
+    # transform all the coordinates
+    reprojected_xyz = reproject_vertices(
+        np.asarray(vertices, dtype=np.float64).reshape(-1, 3),
+        srid_from,
+        srid_to
+    )
+    return reprojected_xyz.tolist()
+
+
+def get_rings(boundaries, rings=None) -> List[List[int]]:
+    """Returns the innermost lists of vertex indices of the boundaries,
+    in order. For a MultiPoint these are the boundaries themselves."""
+    if rings is None:
+        rings = []
+        if not boundaries or not isinstance(boundaries[0], list):
+            rings.append(boundaries)
+            return rings
+    for boundary in boundaries:
+        if boundary and isinstance(boundary[0], list):
+            get_rings(boundary, rings)
+        else:
+            rings.append(boundary)
+    return rings
+
+
+def replace_rings(boundaries, resolved_rings):
+    """Rebuilds the nesting of the boundaries, taking the
+    innermost lists from the resolved_rings iterator."""
+    if not boundaries or not isinstance(boundaries[0], list):
+        return next(resolved_rings)
+    return [
+        replace_rings(boundary, resolved_rings)
+        if boundary and isinstance(boundary[0], list)
+        else next(resolved_rings)
+        for boundary in boundaries
+    ]
 
 
 def resolve(lod_level, vertices, inplace=True):
+    """Replaces the vertex indices of the boundaries with the
+    coordinates of the vertices. The coordinates of all the rings
+    are looked up at once, with a single indexing of the vertex array.
+    """
     if inplace:
         resolvable = lod_level
     else:
-        resolvable = copy.deepcopy(lod_level)
-
-    for boundary in resolvable["boundaries"]:
-        for i, shell in enumerate(boundary):
-            if type(shell[0]) is list:
-                for j, ring in enumerate(shell):
-                    new_ring = []
-                    for vertex_id in ring:
-                        xyz = vertices[vertex_id]
-                        new_ring.append(xyz)
-                    shell[j] = new_ring
-            else:
-                new_shell = []
-                for vertex_id in shell:
-                    xyz = vertices[vertex_id]
-                    new_shell.append(xyz)
-                boundary[i] = new_shell
-
-    return resolvable
-
-
-def resolve_template(lod_level,
-                     vertices,
-                     geometry_templates,
-                     source_target_srid):
-    # get anchor point
-    vertex_id = lod_level["boundaries"][0]
-    anchor = vertices[vertex_id]
+        resolvable = copy.deepcopy(
+            {k: v for k, v in lod_level.items() if k != "boundaries"}
+        )
+    boundaries = lod_level["boundaries"]
 
-    # apply transformation matrix to the template vertices
-    template_vertices = [
-        transform_with_rotation(v, lod_level["transformationMatrix"])
-        for v in geometry_templates["vertices-templates"]
-    ]
+    rings = get_rings(boundaries)
+    indices = np.fromiter(chain.from_iterable(rings), dtype=np.intp)
+    coordinates = np.asarray(vertices)[indices].tolist()
 
-    # add anchor point to the vertices
-    template_vertices = [list(np.array(v) + anchor) for v in template_vertices]
+    ends = np.cumsum([len(ring) for ring in rings]).tolist()
+    starts = [0] + ends[:-1]
+    resolved_rings = (coordinates[start:end]
+                      for start, end in zip(starts, ends))
+    resolvable["boundaries"] = replace_rings(boundaries, resolved_rings)
 
-    # reproject vertices if needed
-    if source_target_srid:
-        template_vertices = reproject_vertex_list(
-            template_vertices, *source_target_srid
-        )
+    return resolvable
 
-    # dereference template vertices
-    template_id = lod_level["template"]
-    template = geometry_templates["templates"][template_id]
 
-    # inplace=False, because the template can be resolved differently
-    # for some other cityobject
-    resolved_template = resolve(template, template_vertices, inplace=False)
-    return resolved_template
+class TemplateResolver:
+    """Resolves the GeometryInstances of a file with its geometry
+    templates. The vertex indices of every template are flattened once,
+    and the template vertices are transformed with a single matrix
+    product per template and transformation matrix. The transformed
+    vertices and their ground geometry are cached, so instances that
+    share a template and a matrix only add their anchor point.
+
+    With keep_instances, the instances are not expanded and only the
+    coordinates of their anchor point are resolved."""
+
+    def __init__(self, geometry_templates, source_target_srid=None,
+                 cache_size=TEMPLATE_CACHE_SIZE, keep_instances=False):
+        self.templates = geometry_templates["templates"]
+        vertices = np.asarray(geometry_templates["vertices-templates"],
+                              dtype=np.float64).reshape(-1, 3)
+        # homogeneous coordinates of the template vertices, as (4, n)
+        self.vertices = np.vstack((vertices.T, np.ones(len(vertices))))
+        self.source_target_srid = source_target_srid
+        self.cache_size = cache_size
+        self.keep_instances = keep_instances
+        # vertex indices and ring ends of the templates
+        self.structures = {}
+        # transformed vertices and ground geometries by template and
+        # transformation matrix, the least recently used are removed
+        self.transformed = OrderedDict()
+        self.ground_geometries = OrderedDict()
+
+    def cache(self, cache, key, value) -> None:
+        cache[key] = value
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def get_structure(self, template_id) -> Tuple[np.ndarray, List[int]]:
+        """Returns the vertex indices of the rings of a template,
+        flattened, and the position after each ring."""
+        structure = self.structures.get(template_id)
+        if structure is None:
+            rings = get_rings(self.templates[template_id]["boundaries"])
+            indices = np.fromiter(chain.from_iterable(rings), dtype=np.intp)
+            ends = np.cumsum([len(ring) for ring in rings]).tolist()
+            structure = self.structures[template_id] = (indices, ends)
+        return structure
+
+    def get_transformed_vertices(self, template_id, matrix) -> np.ndarray:
+        """Returns the vertices of the rings of a template transformed
+        with the transformation matrix, as an (n, 3) array."""
+        key = (template_id, tuple(matrix))
+        transformed = self.transformed.get(key)
+        if transformed is not None:
+            self.transformed.move_to_end(key)
+            return transformed
+
+        indices, _ = self.get_structure(template_id)
+        # matrix multiplication as in
+        # https://www.cityjson.org/dev/geom-templates/
+        t_matrix = np.reshape(np.asarray(matrix, dtype=np.float64), (4, 4))
+        transformed = (t_matrix @ self.vertices[:, indices])[:3].T
+        self.cache(self.transformed, key, transformed)
+        return transformed
+
+    def resolve(self, lod_level, anchor, reproject=True) -> Dict[str, Any]:
+        """Returns the template of a GeometryInstance with the
+        coordinates of its vertices. The anchor point is in the
+        coordinates of the source, as the template is reprojected
+        together with it."""
+        template_id = lod_level["template"]
+        template = self.templates[template_id]
+        coordinates = self.get_transformed_vertices(
+            template_id, lod_level["transformationMatrix"]
+        ) + anchor
+
+        # reproject vertices if needed
+        if reproject and self.source_target_srid:
+            coordinates = reproject_vertices(coordinates,
+                                             *self.source_target_srid)
+        coordinates = coordinates.tolist()
+
+        _, ends = self.get_structure(template_id)
+        starts = [0] + ends[:-1]
+        resolved_rings = (coordinates[start:end]
+                          for start, end in zip(starts, ends))
+        # the other members are shared with the template, the
+        # resolved geometries are not modified afterwards
+        resolved = {k: v for k, v in template.items() if k != "boundaries"}
+        resolved["boundaries"] = replace_rings(template["boundaries"],
+                                               resolved_rings)
+        return resolved
+
+    def reference(self, lod_level, anchor) -> Dict[str, Any]:
+        """Returns a GeometryInstance with the coordinates of its
+        anchor point as boundaries, to be stored unexpanded."""
+        return {**lod_level, "boundaries": [np.asarray(anchor).tolist()]}
+
+    def get_lod(self, lod_level):
+        """Returns the LoD of a GeometryInstance, i.e. of its template."""
+        return self.templates[lod_level["template"]]["lod"]
+
+    def get_ground_geometry(self, lod_level, anchor, obj_id):
+        """Returns the ground geometry of a GeometryInstance. It is
+        derived once per template and transformation matrix and moved
+        to the anchor point, so it cannot be used with reprojection."""
+        key = (lod_level["template"], tuple(lod_level["transformationMatrix"]))
+        if key in self.ground_geometries:
+            self.ground_geometries.move_to_end(key)
+            ground_geometry = self.ground_geometries[key]
+        else:
+            template = self.resolve(lod_level, np.zeros(3), reproject=False)
+            ground_geometry = get_ground_geometry([template], obj_id)
+            self.cache(self.ground_geometries, key, ground_geometry)
+        if ground_geometry is None:
+            return None
+        return shapely.transform(ground_geometry,
+                                 lambda coords: coords + anchor[:2])
 
 
 def resolve_geometry_vertices(
-    geometry, vertices, geometry_templates, source_target_srid
+    geometry, vertices, template_resolver=None, source_vertices=None
 ):
+    """Resolves the coordinates of the geometries of a city object.
+    The anchor points of the GeometryInstances are taken from the
+    source_vertices, the vertices before reprojection, if given."""
+    if source_vertices is None:
+        source_vertices = vertices
     # use ready vertices to resolve coordinate values
     # for the geometry (or geometry template)
     for i, lod_level in enumerate(geometry):
         if lod_level["type"] == "GeometryInstance":
-            resolved_template = resolve_template(
-                lod_level, vertices, geometry_templates, source_target_srid
-            )
-            geometry[i] = resolved_template
+            anchor = source_vertices[lod_level["boundaries"][0]]
+            if template_resolver.keep_instances:
+                geometry[i] = template_resolver.reference(lod_level, anchor)
+            else:
+                geometry[i] = template_resolver.resolve(lod_level, anchor)
         else:
             # resolve without geometry template
             resolve(lod_level, vertices)
@@ -150,27 +298,103 @@ def get_geometry_with_minimum_lod(
         return geometries[index_of_min]
 
 
+def get_coordinate_rings(boundaries, rings=None) -> List[List]:
+    """Returns the rings of resolved boundaries, i.e. the innermost
+    lists of coordinates, in order."""
+    if rings is None:
+        rings = []
+    if boundaries and boundaries[0] \
+            and not isinstance(boundaries[0][0], list):
+        rings.append(boundaries)
+    else:
+        for boundary in boundaries:
+            get_coordinate_rings(boundary, rings)
+    return rings
+
+
+def get_extent(geometry) -> Optional[List[float]]:
+    """Returns the 3D extent of resolved geometries, as
+    [minx, miny, minz, maxx, maxy, maxz], or None if they
+    have no vertices. Geometry instances that are not expanded
+    only count with their anchor point."""
+    rings = []
+    for lod_level in geometry or []:
+        get_coordinate_rings(lod_level["boundaries"], rings)
+    coords, _ = get_ring_arrays(rings)
+    return get_vertices_extent(coords)
+
+
+def get_vertices_extent(vertices: np.ndarray) -> Optional[List[float]]:
+    """Returns the 3D extent of an (n, 3) array of vertices."""
+    if len(vertices) == 0:
+        return None
+    return vertices.min(axis=0).tolist() + vertices.max(axis=0).tolist()
+
+
+def get_ring_arrays(rings: List[List]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the coordinates of all the rings as a single (n, 3)
+    array, together with the number of coordinates of every ring."""
+    lengths = np.fromiter(map(len, rings), dtype=np.intp, count=len(rings))
+    coords = np.array(list(chain.from_iterable(rings)),
+                      dtype=np.float64).reshape(-1, 3)
+    return coords, lengths
+
+
+def get_ring_normals(coords: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Computes the (unit) normals of all the rings at once, with
+    Newell's method. Degenerate rings get a zero normal."""
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    # index of the next vertex of every vertex in its ring
+    following = np.arange(1, len(coords) + 1)
+    following[ends - 1] = starts
+
+    cur, nxt = coords, coords[following]
+    terms = np.column_stack((
+        (cur[:, 1] - nxt[:, 1]) * (cur[:, 2] + nxt[:, 2]),
+        (cur[:, 2] - nxt[:, 2]) * (cur[:, 0] + nxt[:, 0]),
+        (cur[:, 0] - nxt[:, 0]) * (cur[:, 1] + nxt[:, 1]),
+    ))
+    normals = np.add.reduceat(terms, starts, axis=0)
+    norms = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, norms,
+                     out=np.zeros_like(normals),
+                     where=norms > 0)
+
+
+def get_ring_heights(coords: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Returns the mean z of every ring, taken over the closed ring
+    (the first vertex is counted twice if the ring is not closed)."""
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    is_open = (coords[starts] != coords[ends - 1]).any(axis=1)
+    z_sum = np.add.reduceat(coords[:, 2], starts)
+    z_sum = z_sum + np.where(is_open, coords[starts, 2], 0.0)
+    return z_sum / (lengths + is_open)
+
+
+def get_ring_polygons(coords: np.ndarray,
+                      lengths: np.ndarray,
+                      selection: Optional[np.ndarray] = None,
+                      include_z: bool = False) -> np.ndarray:
+    """Builds a polygon for every (selected) ring at once."""
+    if selection is not None:
+        coords = coords[np.repeat(selection, lengths)]
+        lengths = lengths[selection]
+    if not include_z:
+        coords = coords[:, :2]
+    indices = np.repeat(np.arange(len(lengths)), lengths)
+    return shapely.polygons(shapely.linearrings(coords, indices=indices))
+
+
 def get_flattened_polygons_from_boundaries(
     boundaries: List, polygons: Optional[List] = None
 ) -> List[Union[Polygon, MultiPolygon]]:
     if polygons is None:
         polygons = []
-    if (
-        isinstance(boundaries[0], list)
-        and len(boundaries[0]) == 3
-        and all(isinstance(p, float) for p in boundaries[0])
-    ):
-        surface_points = []
-        for point in boundaries:
-            surface_points.append(Point(point[0], point[1], point[2]))
-        polygons.append(Polygon(surface_points))
-        return polygons
-    else:
-        for shell in boundaries:
-            polygons = get_flattened_polygons_from_boundaries(
-                shell,
-                polygons=polygons)
-        return polygons
+    coords, lengths = get_ring_arrays(get_coordinate_rings(boundaries))
+    polygons.extend(get_ring_polygons(coords, lengths, include_z=True))
+    return polygons
 
 
 def is_surface_vertical(normal: np.ndarray) -> bool:
@@ -182,31 +406,84 @@ def is_surface_vertical(normal: np.ndarray) -> bool:
     We check if the vectors are perpendicular to each other
     by calculating their dot product. If the dot product is
     close to 0 then the vectors are perpendicular.
+    The normal can also be a (3, n) array of normals, in which
+    case a boolean array is returned.
     """
     dot_prd = 0 * normal[0] \
         + 0 * normal[1] \
         + 1 * normal[2]
 
-    if abs(dot_prd) < 0.1:
-        return True
-    else:
-        return False
+    return np.abs(dot_prd) < 0.1
+
+
+def get_ground_selection(coords: np.ndarray,
+                         lengths: np.ndarray) -> np.ndarray:
+    """Selects the rings that are ground surfaces: the non-vertical
+    ones that are lower than the mean height of the non-vertical
+    surfaces."""
+    normals = get_ring_normals(coords, lengths)
+    selection = ~is_surface_vertical(normals.T)
+    if not selection.any():
+        raise Exception("The geometry has no non-vertical surfaces")
+    heights = get_ring_heights(coords, lengths)
+    # the mean is taken over the distinct heights, so that many
+    # surfaces at the same height do not pull it down
+    z_mean = np.unique(heights[selection]).mean()
+    return selection & (heights < z_mean)
+
+
+def is_surface(boundary) -> bool:
+    """Checks if resolved boundaries are a single surface,
+    i.e. a list of rings of coordinates."""
+    return bool(boundary) and bool(boundary[0]) \
+        and bool(boundary[0][0]) \
+        and not isinstance(boundary[0][0][0], list)
+
+
+def get_semantic_selection(
+    geometry: Dict[str, Any], surface_type: str = "GroundSurface"
+) -> Optional[np.ndarray]:
+    """Selects the rings of the surfaces that have the given semantic
+    type, in the order of get_coordinate_rings. Returns None when the
+    geometry has no surfaces of that type."""
+    semantics = geometry.get("semantics")
+    if not semantics or not semantics.get("values"):
+        return None
+    is_type = [surface.get("type") == surface_type
+               for surface in semantics.get("surfaces", [])]
+    if not any(is_type):
+        return None
+
+    selection = []
+
+    def select(boundaries, values):
+        values = values if isinstance(values, list) else []
+        for i, boundary in enumerate(boundaries):
+            value = values[i] if i < len(values) else None
+            if is_surface(boundary):
+                selected = isinstance(value, int) \
+                    and 0 <= value < len(is_type) \
+                    and is_type[value]
+                selection.extend(selected for ring in boundary if ring)
+            elif boundary:
+                select(boundary, value)
+
+    boundaries = geometry["boundaries"]
+    if is_surface(boundaries):
+        # a single surface has no list of values
+        boundaries = [boundaries]
+    select(boundaries, semantics["values"])
+    return np.array(selection, dtype=bool)
 
 
 def get_ground_surfaces(polygons: List[Polygon]) -> List[Polygon]:
-    ground_surfaces = {}
-    for polygon in polygons:
-        xyz = np.asarray(polygon.exterior.coords)[0:-1]
-        normal, is_coplanar = get_normal_newell(xyz)
-        if is_surface_vertical(normal):
-            continue
-        else:
-            z = mean([point[2] for point in polygon.exterior.coords])
-            ground_surfaces[z] = force_2d(polygon)
-    if len(ground_surfaces) == 0:
-        raise Exception(polygons)
-    z_mean = mean(ground_surfaces.keys())
-    return [v for k, v in ground_surfaces.items() if k < z_mean]
+    exteriors = shapely.get_exterior_ring(np.asarray(polygons))
+    coords, index = shapely.get_coordinates(exteriors,
+                                            include_z=True,
+                                            return_index=True)
+    lengths = np.bincount(index, minlength=len(exteriors))
+    selection = get_ground_selection(coords, lengths)
+    return list(force_2d(np.asarray(polygons)[selection]))
 
 
 def merge_into_a_multipolygon(ground_surfaces:
@@ -227,8 +504,9 @@ def get_ground_geometry(
     and extracts only the ground surface.
     If there is an LoD 0, then all the available surfaces
     are merged and returned.
-    If not, then only the non-vertical surfaces with the lowest
-    height are merged and returned.
+    If not, then the surfaces with a GroundSurface semantic are
+    merged and returned. Without those, only the non-vertical surfaces
+    with the lowest height are merged and returned.
     """
     geometry = get_geometry_with_minimum_lod(geometries)
 
@@ -245,15 +523,20 @@ def get_ground_geometry(
         # TODO return convex hull of the points as ground geometry.
         return None
 
+    coords, lengths = get_ring_arrays(
+        get_coordinate_rings(geometry["boundaries"])
+    )
     if float(geometry["lod"]) < 1:
-        flattented_polygons = get_flattened_polygons_from_boundaries(
-            geometry["boundaries"]
-        )
-        return merge_into_a_multipolygon(flattented_polygons)
+        # all the surfaces are merged
+        ground_surfaces = get_ring_polygons(coords, lengths)
     else:
-        # TODO: check if there are surface types available
-        # to choose the ground surfaces
-        surfaces = get_flattened_polygons_from_boundaries(
-            geometry["boundaries"])
-        ground_surfaces = get_ground_surfaces(surfaces)
-        return merge_into_a_multipolygon(ground_surfaces)
+        # the ground surfaces are taken from the semantics when
+        # they are tagged, otherwise they are found from the normals
+        # and the heights of the surfaces
+        selection = get_semantic_selection(geometry)
+        if selection is None \
+                or len(selection) != len(lengths) \
+                or not selection.any():
+            selection = get_ground_selection(coords, lengths)
+        ground_surfaces = get_ring_polygons(coords, lengths, selection)
+    return merge_into_a_multipolygon(ground_surfaces)
@@ -1,28 +1,44 @@
-import json
 import os
 import sys
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
 from pathlib import Path
-from typing import Optional, Tuple
 
-from shapely.geometry.base import BaseGeometry
-from sqlalchemy import func, text
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import (String, any_, bindparam, create_engine, delete,
+                        func, or_, select, text)
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import Session
 
 import cjdb.modules.exceptions as exceptions
 from cjdb.logger import logger
 from cjdb.model.sqlalchemy_models import (BaseModel,
                                           CityObjectRelationshipModel,
-                                          CjMetadataModel, CjObjectModel)
-from cjdb.modules.checks import (check_object_type,
-                                 check_root_properties)
-from cjdb.modules.extensions import ExtensionHandler
-from cjdb.modules.geometric import (get_ground_geometry, get_srid,
-                                    reproject_vertex_list,
-                                    resolve_geometry_vertices,
-                                    transform_vertex)
+                                          CjFeatureModel, CjMetadataModel,
+                                          CjObjectModel)
+from cjdb.modules.checks import check_root_properties
+from cjdb.modules.codec import dumps, loads
+from cjdb.modules.extensions import ExtensionCache, ExtensionHandler
+from cjdb.modules.geometric import get_srid, reproject_vertex_list
+from cjdb.modules.loader import copy_lines, copy_rows
+from cjdb.modules.processing import (OBJECT_COLUMNS, FeatureContext,
+                                     process_lines)
+from cjdb.modules.schema import (PARTITION_KEYS, add_missing_columns,
+                                 create_file_partitions,
+                                 create_partitioned_tables,
+                                 drop_file_partitions, get_partition_key,
+                                 table_exists)
 from cjdb.modules.utils import (find_extra_properties, get_city_object_types,
-                                is_cityjson_object, is_valid_file, to_dict)
+                                get_file_hash, get_hash_key, hash_file,
+                                is_cityjson_object, is_valid_file,
+                                new_file_hash)
+
+# number of ids reserved at once from the id sequence of the schema
+ID_BLOCK_SIZE = 10000
+# maximum number of indexes that are built at the same time
+MAX_INDEX_BUILDS = 4
+# columns of the city object rows of a batch, formatted for COPY
+ROW_COLUMNS = ("id", "cj_metadata_id") + OBJECT_COLUMNS
 
 
 # class to store variables per file import - for clarity
@@ -35,15 +51,38 @@ class SingleFileImport:
         self.extension_handler = (
             None  # data about extensions - extra properties, root attributes
         )
+        self.context = None  # what is needed to process the features
+        # position in the file after the last processed feature
+        self.position = 0
+        # hash of the file content before position, updated while the
+        # features are read and stored when the import finishes
+        self.file_hash = None
+        # when updating an imported file: the feature ids of its
+        # imported features by their hash, otherwise None
+        self.unchanged = None
+        # hashes of the unchanged features found again by the update
+        self.seen = set()
+        # feature ids imported again by the update
+        self.updated = set()
         self.city_objects = []
         self.families = []
+        self.features = []
+        # size of the batch that has not been flushed to the database yet
+        self.batch_features = 0
+        self.batch_bytes = 0
 
 
 # importer class called once per whole import
 class Importer:
     def __init__(self, engine, filepath, db_schema, input_srid,
                  indexed_attributes, partial_indexed_attributes,
-                 ignore_repeated_file, overwrite, transform):
+                 ignore_repeated_file, overwrite, transform,
+                 batch_size=1000, batch_memory=64, jobs=1,
+                 bulk=False, maintenance_work_mem=512,
+                 maintenance_workers=None, cluster_threshold=0.2, partition=None,
+                 resume=False, update=False, keep_templates=False,
+                 storage="json", offline=False, extension_mirror=None,
+                 extension_ttl=24, interactive=True):
         self.engine = engine
         self.filepath = filepath
         self.db_schema = db_schema
@@ -52,9 +91,55 @@ class Importer:
         self.partial_indexed_attributes = partial_indexed_attributes
         self.ignore_repeated_file = ignore_repeated_file
         self.overwrite = overwrite
+        # last id given out and last id reserved from the sequence
         self.max_id = 0
-        self.processed = dict()
+        self.reserved_id = 0
         self.transform = transform
+        # flush to the database every batch_size features
+        # or every batch_memory MB of input, whichever comes first
+        self.batch_size = batch_size
+        self.batch_memory = batch_memory
+        # number of processes used to process the features,
+        # or the files when importing a directory
+        self.jobs = jobs
+        # drop the secondary indexes during the import
+        # and rebuild them afterwards
+        self.bulk = bulk
+        # maintenance_work_mem (in MB) of the index builds and clustering
+        self.maintenance_work_mem = maintenance_work_mem
+        # max_parallel_maintenance_workers of the index builds and
+        # clustering, the setting of the server if None
+        self.maintenance_workers = maintenance_workers
+        # the city objects are only clustered again when the objects
+        # added by the import are at least this fraction of the table
+        self.cluster_threshold = cluster_threshold
+        # number of city objects added by the import
+        self.added_objects = 0
+        # partition layout for a new schema (see schema.PARTITION_KEYS)
+        self.partition = partition
+        # column the city objects of the schema are partitioned by,
+        # set when the database is prepared
+        self.partition_key = None
+        # continue unfinished imports and skip the finished ones
+        self.resume = resume
+        # only import the features that changed in files that
+        # were imported before, and remove the missing ones
+        self.update = update
+        # store the geometry instances with their anchor point instead
+        # of expanding them with their template
+        self.keep_templates = keep_templates
+        # storage format of the geometries (see storage.STORAGE_FORMATS)
+        self.storage = storage
+        # where the schemas of the extensions are resolved from,
+        # shared by all the files of the import
+        self.offline = offline
+        self.extension_mirror = extension_mirror
+        self.extension_ttl = extension_ttl
+        self.extension_cache = ExtensionCache(offline,
+                                              extension_mirror,
+                                              extension_ttl)
+        # whether the user can be asked questions during the import
+        self.interactive = interactive
 
         # get allowed types for validation
         self.city_object_types = get_city_object_types()
@@ -68,13 +153,23 @@ class Importer:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.release_ids()
         self.session.close()
 
     def run_import(self) -> None:
         self.prepare_database()
-        self.max_id = CjObjectModel.get_max_id(self.session)
-        self.parse_cityjson()
-        self.session.commit()
+        index_definitions = []
+        if self.bulk:
+            index_definitions = self.drop_secondary_indexes()
+        try:
+            self.parse_cityjson()
+            self.session.commit()
+        finally:
+            # the indexes are rebuilt even if the import failed,
+            # as the batches written before are kept
+            if index_definitions:
+                self.session.rollback()
+                self.build_indexes(index_definitions)
         # post import operations like clustering, indexing...
         self.post_import()
         self.session.commit()
@@ -83,13 +178,51 @@ class Importer:
         """Adds the postgis extension and creates
         the schema and the tables."""
         with self.engine.connect() as conn:
+            # importers running at the same time would otherwise
+            # race each other creating the same objects
+            conn.execute(
+                text("SELECT pg_advisory_xact_lock(hashtext('cjdb'))")
+            )
             conn.execute(text("""CREATE EXTENSION IF NOT EXISTS postgis"""))
             conn.execute(text(f"""CREATE SCHEMA IF NOT EXISTS
                                   {self.db_schema}"""))
+            # the partitioned layout is only used for a new schema
+            CjMetadataModel.__table__.create(conn, checkfirst=True)
+            if self.partition and not table_exists(
+                conn, self.db_schema, CjObjectModel.__table__.name
+            ):
+                create_partitioned_tables(conn,
+                                          self.db_schema,
+                                          self.partition)
+            # create all tables defined as SqlAlchemy models
+            for table in BaseModel.metadata.tables.values():
+                table.create(conn, checkfirst=True)
+                add_missing_columns(conn, table)
+
+            self.partition_key = get_partition_key(
+                conn, self.db_schema, CjObjectModel.__table__.name
+            )
+            if self.partition and \
+                    self.partition_key != PARTITION_KEYS[self.partition]:
+                logger.warning(
+                    "The schema %s already exists with another layout, "
+                    "it is not partitioned by %s.",
+                    self.db_schema, self.partition
+                )
+            self.create_functions(conn)
             conn.commit()
-        # create all tables defined as SqlAlchemy models
-        for table in BaseModel.metadata.tables.values():
-            table.create(self.engine, checkfirst=True)
+
+    def create_functions(self, conn) -> None:
+        """Creates the SQL functions decoding the geometries
+        stored in the compact format."""
+        cur_path = Path(__file__).parent
+        sql_path = os.path.join(cur_path.parent, "resources/functions.sql")
+
+        with open(sql_path) as f:
+            cmd = f.read().format(schema=self.db_schema)
+        # the function bodies contain semicolons and colons,
+        # so the file is sent as it is
+        conn.exec_driver_sql(cmd)
 
     def parse_cityjson(self) -> None:
         """Parses the input path."""
@@ -113,10 +246,130 @@ class Importer:
 
         with open(sql_path) as f:
             cmd = f.read().format(schema=self.db_schema)
-        with self.engine.connect() as conn:
-            conn.execute(text(cmd))
+        statements = [
+            statement.strip() for statement in cmd.split(";")
+            if statement.strip()
+        ]
+        # the indexes are built first and in parallel, the clustering
+        # statements need them
+        self.build_indexes([s for s in statements if is_index(s)])
+        with self.engine.begin() as conn:
+            self.set_maintenance_settings(conn)
+            for statement in statements:
+                if not is_index(statement):
+                    conn.execute(text(statement))
+        self.cluster_city_objects()
         self.index_attributes()
 
+    def cluster_city_objects(self) -> None:
+        """Clusters the city objects on their ground geometries.
+        CLUSTER rewrites the whole table under an exclusive lock,
+        so it is skipped when the import only added a small part
+        of the table (less than cluster_threshold)."""
+        table = f"{self.db_schema}.{CjObjectModel.__table__.name}"
+        if self.partition_key:
+            # older PostgreSQL versions cannot cluster partitioned
+            # tables, the batches are ordered by ground geometry instead
+            logger.info("Not clustering the partitioned table %s", table)
+            return
+        with self.engine.begin() as conn:
+            # the statistics are refreshed after the import anyway,
+            # and they give the size of the table without a count
+            conn.execute(text(f"ANALYZE {table}"))
+            total = conn.execute(
+                text("SELECT reltuples FROM pg_class "
+                     "WHERE oid = CAST(:table AS regclass)"),
+                {"table": table}
+            ).scalar()
+            if total > 0 and self.added_objects < \
+                    self.cluster_threshold * total:
+                logger.info(
+                    "Not clustering %s: %s of about %s objects were added",
+                    table, self.added_objects, int(total)
+                )
+                return
+            logger.info("Clustering %s", table)
+            self.set_maintenance_settings(conn)
+            conn.execute(
+                text(f"CLUSTER {table} USING city_object_ground_gix")
+            )
+
+    def set_maintenance_settings(self, conn) -> None:
+        """Sets the memory and parallelism of index builds and
+        clustering for the current transaction of the connection."""
+        conn.execute(text(
+            f"SET LOCAL maintenance_work_mem = '{self.maintenance_work_mem}MB'"
+        ))
+        if self.maintenance_workers is not None:
+            conn.execute(text(
+                "SET LOCAL max_parallel_maintenance_workers = "
+                f"{self.maintenance_workers}"
+            ))
+
+    def get_secondary_indexes(self, conn):
+        """Returns the names and definitions of the indexes of the
+        city object tables that do not back a constraint."""
+        tables = [
+            f"{table.schema}.{table.name}"
+            for table in (CjObjectModel.__table__,
+                          CityObjectRelationshipModel.__table__)
+        ]
+        return conn.execute(
+            text("""SELECT index_class.relname,
+                           pg_get_indexdef(pg_index.indexrelid)
+                    FROM pg_index
+                    JOIN pg_class index_class
+                      ON index_class.oid = pg_index.indexrelid
+                    WHERE pg_index.indrelid = ANY(
+                        CAST(:tables AS regclass[]))
+                      AND NOT EXISTS (
+                        SELECT 1 FROM pg_constraint
+                        WHERE pg_constraint.conindid = pg_index.indexrelid)
+                 """),
+            {"tables": tables}
+        ).all()
+
+    def drop_secondary_indexes(self):
+        """Drops the secondary indexes of the city object tables,
+        so that they are not updated row by row during a bulk load.
+        Returns the definitions to rebuild them."""
+        with self.engine.begin() as conn:
+            indexes = self.get_secondary_indexes(conn)
+            for name, _ in indexes:
+                logger.info("Dropping index %s for the bulk load", name)
+                conn.execute(text(
+                    f'DROP INDEX IF EXISTS {self.db_schema}."{name}"'
+                ))
+        # the indexes of a partitioned table are defined ON ONLY the
+        # table, which would rebuild them as invalid indexes without
+        # the partitions
+        return [definition.replace(" ON ONLY ", " ON ", 1)
+                for _, definition in indexes]
+
+    def build_indexes(self, statements) -> None:
+        """Runs the index statements, several at the same time, each
+        in its own transaction. PostgreSQL can also use parallel
+        workers within each build, see set_maintenance_settings."""
+        def build(statement):
+            logger.debug("Building index: %s", statement)
+            with self.engine.begin() as conn:
+                # importers finishing at the same time would otherwise
+                # fail creating the same index
+                conn.execute(
+                    text("SELECT pg_advisory_xact_lock(hashtext(:sql))"),
+                    {"sql": statement}
+                )
+                self.set_maintenance_settings(conn)
+                conn.execute(text(statement))
+
+        if not statements:
+            return
+        logger.info("Building %s indexes", len(statements))
+        workers = min(len(statements), MAX_INDEX_BUILDS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() raises the exception of a failed build
+            list(executor.map(build, statements))
+
     def set_target_srid(self) -> None:
         """
         This function sets the  target SRID for the file being imported,
@@ -208,7 +461,7 @@ class Importer:
 
         # store extensions data - extra root properties, extra city objects
         self.current.extension_handler = ExtensionHandler(
-            line_json.get("extensions")
+            line_json.get("extensions"), self.extension_cache
         )
 
         # prepare extra properties coming from extensions
@@ -224,6 +477,11 @@ class Importer:
             self.current.extension_handler.extra_root_properties,
         )
 
+        # the SRIDs change the imported geometries,
+        # so they are hashed with the content
+        hash_key = get_hash_key([self.current.source_srid,
+                                 self.current.target_srid])
+
         # "or None" is added to change empty json "{}" to database null
         cj_metadata = CjMetadataModel(
             source_file=os.path.basename(self.current.file),
@@ -237,13 +495,73 @@ class Importer:
             bbox=bbox,
         )
 
+        update_target = None
         if cj_metadata.source_file.lower() != "stdin":
             # compare to existing import metas
             imported_files = cj_metadata.get_already_imported_files(
                 self.session
             )
 
-            if (
+            if not self.overwrite and imported_files.first():
+                # only a file that was imported before is hashed
+                # up front, the others are hashed while they are read
+                cj_metadata.content_hash = get_file_hash(self.current.file,
+                                                         hash_key)
+                unchanged = cj_metadata.get_unchanged_import(self.session)
+                if unchanged:
+                    logger.info("File %s did not change since it was "
+                                "imported on %s. Skipping...",
+                                cj_metadata.source_file,
+                                unchanged.finished_at)
+                    return False
+
+            if self.resume:
+                if imported_files.first():
+                    logger.info("File %s was already imported. Skipping...",
+                                cj_metadata.source_file)
+                    return False
+                unfinished = cj_metadata.get_unfinished_import(self.session)
+                if unfinished:
+                    # the bytes imported so far must not have changed
+                    self.current.file_hash = hash_file(
+                        self.current.file, hash_key,
+                        unfinished.imported_bytes or 0
+                    )
+                if unfinished and unfinished.imported_bytes and \
+                        unfinished.imported_hash != \
+                        self.current.file_hash.hexdigest():
+                    # the position of the interrupted import is not
+                    # valid in a file that changed since
+                    logger.warning("File %s changed since its import was "
+                                   "interrupted, it is imported again "
+                                   "from the start",
+                                   cj_metadata.source_file)
+                    if self.partition_key == PARTITION_KEYS["file"]:
+                        drop_file_partitions(self.session.connection(),
+                                             self.db_schema,
+                                             unfinished.id)
+                    self.session.delete(unfinished)
+                    self.session.flush()
+                    self.current.file_hash = None
+                elif unfinished:
+                    logger.info(
+                        "Resuming the import of %s after %s features",
+                        cj_metadata.source_file,
+                        unfinished.imported_features or 0
+                    )
+                    self.current.cj_metadata = unfinished
+                    return True
+
+            if self.update and not self.overwrite:
+                update_target = imported_files.order_by(
+                    CjMetadataModel.id.desc()
+                ).first()
+
+            if update_target:
+                logger.info("Updating the features of %s imported on %s",
+                            cj_metadata.source_file,
+                            update_target.finished_at)
+            elif (
                 self.ignore_repeated_file and
                     imported_files.first() and 
                     not self.overwrite):
@@ -256,6 +574,12 @@ class Importer:
                     "to skip already imported files.",
                     cj_metadata.source_file, imported_files.first().finished_at
                 )
+                if not self.interactive:
+                    logger.warning(
+                        f"Import of file {cj_metadata.source_file} "
+                        "skipped, because it cannot prompt for "
+                        "confirmation.")
+                    return False
                 user_answer = input(
                     "Should the import continue? "
                     "Already imported city objects will be skipped. "
@@ -272,6 +596,13 @@ class Importer:
                 logger.warning(
                     "File already imported. Overwriting all objects"
                     f" from source file {cj_metadata.source_file}")
+                if self.partition_key == PARTITION_KEYS["file"]:
+                    # the objects of each file are in their own
+                    # partitions, which are dropped as a whole
+                    for imported_file in imported_files:
+                        drop_file_partitions(self.session.connection(),
+                                             self.db_schema,
+                                             imported_file.id)
                 imported_files.delete()
 
         different_srid = cj_metadata.different_srid_meta(self.session)
@@ -282,150 +613,398 @@ class Importer:
                          cj_metadata.srid, different_srid.srid)
             raise exceptions.InconsistentCRSException()
 
+        if self.current.file.lower() != "stdin":
+            self.current.file_hash = new_file_hash(hash_key)
+
+        if update_target:
+            self.start_update(update_target, cj_metadata)
+            return True
+
         # add metadata to the database
         cj_metadata.__table__.schema = self.db_schema
         self.current.cj_metadata = cj_metadata
         self.session.add(cj_metadata)
+        if self.partition_key == PARTITION_KEYS["file"]:
+            self.session.flush()
+            create_file_partitions(self.session.connection(),
+                                   self.db_schema,
+                                   cj_metadata.id)
         self.session.commit()
         return True
 
-    def process_line(self, line_json) -> None:
-        # unpack vertices for the cityobjects based on
-        # the CityJSON transform
-        # this is done once for the CityJSONFeature
-        vertices = [
-            transform_vertex(v, self.current.cj_metadata.transform)
-            for v in line_json["vertices"]
-        ]
+    def start_update(self, cj_metadata, new_cj_metadata) -> None:
+        """Prepares the update of an imported file. Its metadata is
+        replaced and the hashes of its features are loaded, so that
+        only the features that changed are imported again.
+        The content hash of the file is only replaced when the update
+        finishes, so an interrupted update is imported again."""
+        for column in ("version", "meta", "transform",
+                       "geometry_templates", "srid", "extensions",
+                       "extra_properties", "bbox"):
+            setattr(cj_metadata, column, getattr(new_cj_metadata, column))
+        cj_metadata.imported_features = 0
+        cj_metadata.imported_bytes = 0
+        self.current.cj_metadata = cj_metadata
+        self.current.unchanged = CjFeatureModel.get_hashes(self.session,
+                                                           cj_metadata.id)
+        if not self.current.unchanged:
+            logger.warning("File %s was imported without feature hashes, "
+                           "all its objects are imported again",
+                           cj_metadata.source_file)
+            self.delete_features()
+        self.session.commit()
 
-        # reproject if needed
-        source_target_srid = None
-        if (
-            self.current.target_srid != self.current.source_srid
-        ):
-            source_target_srid = (
-                self.current.source_srid,
-                self.current.target_srid,
+    def finish_update(self) -> None:
+        """Removes the features that are not in the updated file."""
+        removed = {
+            feature_id
+            for feature_hash, feature_id in self.current.unchanged.items()
+            if feature_hash not in self.current.seen
+        } - self.current.updated
+        if removed:
+            self.delete_features(removed)
+        logger.info("Updated %s features, removed %s features, "
+                    "%s features did not change",
+                    len(self.current.updated), len(removed),
+                    len(self.current.seen))
+        self.current.cj_metadata.imported_features += len(self.current.seen)
+
+    def delete_features(self, feature_ids=None) -> None:
+        """Deletes the objects of features of the current file, with
+        their relationships and hashes. Without feature ids all the
+        objects of the file are deleted."""
+        objects = CjObjectModel.__table__
+        relationships = CityObjectRelationshipModel.__table__
+        features = CjFeatureModel.__table__
+        cj_metadata_id = self.current.cj_metadata.id
+        object_conditions = [objects.c.cj_metadata_id == cj_metadata_id]
+        feature_conditions = [features.c.cj_metadata_id == cj_metadata_id]
+        if feature_ids is not None:
+            feature_ids = bindparam("feature_ids",
+                                    list(feature_ids),
+                                    type_=ARRAY(String))
+            object_conditions.append(objects.c.feature_id == any_(feature_ids))
+            feature_conditions.append(
+                features.c.feature_id == any_(feature_ids)
             )
-            vertices = reproject_vertex_list(vertices, *source_target_srid)
-
+        object_ids = select(objects.c.id).where(*object_conditions)
+        self.session.execute(delete(relationships).where(or_(
+            relationships.c.parent_id.in_(object_ids),
+            relationships.c.child_id.in_(object_ids),
+        )))
+        self.session.execute(delete(objects).where(*object_conditions))
+        self.session.execute(delete(features).where(*feature_conditions))
+
+    def set_feature_context(self) -> None:
+        """Prepares what is needed to process the features of the file,
+        also in worker processes."""
+        cj_metadata = self.current.cj_metadata
+        self.current.context = FeatureContext(
+            transform=self.current.cj_metadata.transform,
+            geometry_templates=self.current.cj_metadata.geometry_templates,
+            source_srid=self.current.source_srid,
+            target_srid=self.current.target_srid,
+            city_object_types=self.city_object_types,
+            extra_city_objects=(
+                self.current.extension_handler.extra_city_objects
+            ),
+            keep_templates=self.keep_templates,
+            storage=self.storage,
+        )
+        if self.keep_templates and cj_metadata.geometry_templates and \
+                not self.current.context.keep_templates:
+            logger.warning("The geometry instances of %s are expanded, "
+                           "because they are reprojected",
+                           self.current.file)
+        if self.storage == "compact" and not self.current.context.compact:
+            logger.warning("The geometries of %s are stored as json, "
+                           "because they are reprojected",
+                           self.current.file)
+        # the features are hashed with what their geometries depend on
+        self.current.context.hash_key = get_hash_key([
+            self.current.source_srid,
+            self.current.target_srid,
+            cj_metadata.transform,
+            cj_metadata.geometry_templates,
+            self.current.context.keep_templates,
+            self.current.context.compact,
+        ])
+        self.current.context.unchanged = frozenset(self.current.unchanged
+                                                   or ())
+
+    def new_id(self) -> int:
+        """Returns the next free city object id. The ids are reserved
+        in blocks from the id sequence of the schema, so several
+        importers can load into the same schema at the same time."""
+        if self.max_id >= self.reserved_id:
+            self.max_id = CjObjectModel.reserve_ids(self.engine,
+                                                    ID_BLOCK_SIZE)
+            self.reserved_id = self.max_id + ID_BLOCK_SIZE
+        self.max_id = self.max_id + 1
+        return self.max_id
+
+    def release_ids(self) -> None:
+        """Gives the ids that were reserved but not used back."""
+        if self.max_id < self.reserved_id:
+            CjObjectModel.release_ids(self.engine,
+                                      self.max_id,
+                                      self.reserved_id)
+            self.reserved_id = self.max_id
+
+    def add_feature(self, feature_id, city_objects,
+                    feature_hash=None) -> None:
+        """Gives ids to the encoded objects of a CityJSONFeature
+        and adds them to the current batch. The ids are given in
+        the order of the input, also when using worker processes."""
+        # the hash of the feature finds the features that changed
+        # when the file is updated
+        if feature_hash and feature_id is not None and city_objects:
+            self.current.features.append({
+                "cj_metadata_id": self.current.cj_metadata.id,
+                "feature_id": feature_id,
+                "hash": feature_hash,
+            })
+            if self.current.unchanged is not None:
+                self.current.updated.add(feature_id)
+
+        # ids given to the objects of this CityJSONFeature.
+        # Children are always part of the same CityJSONFeature, so
+        # the lookup does not need to outlive the feature.
+        processed = {}
         # list of relationships for the CityJSONFeature
         city_object_relationships_ties = []
-        # objects for the CityJSONFeature
-        cj_feature_objects = {}
-
-        # create CityJSONObjects
-        for obj_id, cityobj in line_json["CityObjects"].items():
-
-            # get 3D geom, ground geom and bbox
-            geometry, ground_geometry = self.get_geometries(
-                obj_id, cityobj, vertices, source_target_srid
-            )
 
-            # check if the object type is allowed by the official
-            # spec or extension
-            check_result, message = check_object_type(
-                cityobj.get("type"),
-                self.city_object_types,
-                self.current.extension_handler.extra_city_objects,
-            )
-            if not check_result:
-                logger.info(message)
-
-            # update or insert the object
-            # 'or None' is added to change empty json "{}" to database null
-
-            city_object_id = self.processed.get(obj_id, None)
+        for obj_id, children, columns in city_objects:
+            city_object_id = processed.get(obj_id, None)
             if not city_object_id:
-                self.max_id = self.max_id + 1
-                self.processed[obj_id] = self.max_id
-                city_object_id = self.max_id
-            city_object = CjObjectModel(
-                id=city_object_id,
-                object_id=obj_id,
-                type=cityobj.get("type"),
-                attributes=cityobj.get("attributes") or None,
-                geometry=geometry,
-                ground_geometry=ground_geometry,
+                city_object_id = self.new_id()
+                processed[obj_id] = city_object_id
+            # the row is loaded with the columns of ROW_COLUMNS
+            self.current.city_objects.append(
+                f"{city_object_id}\t{self.current.cj_metadata.id}\t{columns}"
             )
 
-            # add CityJson object to the database
-            city_object.__table__.schema = self.db_schema
-            city_object.cj_metadata_id = self.current.cj_metadata.id
-            self.current.city_objects.append(to_dict(city_object))
-
-            cj_feature_objects[obj_id] = city_object
-
             # save children-parent links
-            for child_id in cityobj.get("children", []):
-                child_unique_id = self.processed.get(child_id, None)
+            for child_id in children:
+                child_unique_id = processed.get(child_id, None)
                 if child_unique_id:
                     city_object_relationships_ties.append((city_object_id,
                                                            child_unique_id))
                 else:
-                    self.max_id = self.max_id + 1
-                    self.processed[child_id] = self.max_id
+                    child_unique_id = self.new_id()
+                    processed[child_id] = child_unique_id
                     city_object_relationships_ties.append((city_object_id,
-                                                           self.max_id))
+                                                           child_unique_id))
 
         # create children-parent links after all objects
         # from the CityJSONFeature already exist
         for parent_id, child_id in city_object_relationships_ties:
-            self.current.families.append({"parent_id": parent_id,
-                                          "child_id": child_id})
+            self.current.families.append({
+                "parent_id": parent_id,
+                "child_id": child_id,
+                "cj_metadata_id": self.current.cj_metadata.id,
+            })
 
     def process_file(self, filepath) -> bool:
-        """Process a single cityJSON file"""
+        """Process a single cityJSON file.
+        The features are read lazily and flushed to the database
+        in batches, so memory use does not depend on the file size."""
         self.current = SingleFileImport(filepath)
         logger.info("Running import for file: %s", filepath)
 
         if filepath.lower() == "stdin":
-            f = sys.stdin
+            # read bytes, so the lines can be decoded without
+            # an intermediate str when orjson is available
+            f = getattr(sys.stdin, "buffer", sys.stdin)
         else:
             if not is_valid_file(filepath):
                 raise exceptions.InvalidFileException()
-            f = open(filepath, "rt")
-
-        first_line = f.readline()
-        first_line_json = json.loads(first_line.rstrip("\n"))
-        if not is_cityjson_object(first_line_json):
-            raise exceptions.InvalidCityJSONObjectException()
-        metadata_ok = self.extract_cj_metadatadata(first_line_json)
-        if not metadata_ok:
-            return False
-        for line in f.readlines():
-            line_json = json.loads(line.rstrip("\n"))
-            self.process_line(line_json)
-
-        if self.current.city_objects:
-            obj_insert = (
-                insert(CjObjectModel)
-                .values(self.current.city_objects)
-                .on_conflict_do_nothing()
-            )
-            self.session.execute(obj_insert)
-        self.session.commit()
-
-        if self.current.families:
-            city_object_relationships_insert = (
-                insert(CityObjectRelationshipModel)
-                .values(self.current.families)
-                .on_conflict_do_nothing()
-            )
-            self.session.execute(city_object_relationships_insert)
+            f = open(filepath, "rb")
+
+        try:
+            first_line = f.readline()
+            first_line_json = loads(first_line)
+            if not is_cityjson_object(first_line_json):
+                raise exceptions.InvalidCityJSONObjectException()
+            metadata_ok = self.extract_cj_metadatadata(first_line_json)
+            if not metadata_ok:
+                return False
+            self.set_feature_context()
+
+            # continue after the features of a resumed import,
+            # an update reads the whole file again
+            self.current.position = len(first_line)
+            if self.current.unchanged is None and \
+                    self.current.cj_metadata.imported_bytes:
+                self.current.position = self.current.cj_metadata.imported_bytes
+                f.seek(self.current.position)
+            elif self.current.file_hash is not None:
+                self.current.file_hash.update(first_line)
+
+            reader = FeatureReader(f, self.current.position)
+            for line, processed in process_lines(reader,
+                                                 self.current.context,
+                                                 self.jobs):
+                self.current.position, skipped = reader.pending.popleft()
+                if self.current.file_hash is not None:
+                    self.current.file_hash.update(skipped)
+                    self.current.file_hash.update(line)
+                feature_hash, feature_id, city_objects = processed
+                if city_objects is None:
+                    # the feature did not change since the last import
+                    self.current.seen.add(feature_hash)
+                    continue
+                self.add_feature(feature_id, city_objects, feature_hash)
+                self.current.batch_features += 1
+                self.current.batch_bytes += len(line)
+                if self.batch_is_full():
+                    self.flush_batch()
+        finally:
+            if filepath.lower() != "stdin":
+                f.close()
+
+        # also after the unchanged features at the end of the file
+        self.current.position = reader.position
+        if self.current.file_hash is not None:
+            self.current.file_hash.update(reader.skipped)
+        self.flush_batch()
+        if self.current.unchanged is not None:
+            self.finish_update()
+        if self.current.file_hash is not None:
+            self.current.cj_metadata.content_hash = \
+                self.current.file_hash.hexdigest()
         self.current.cj_metadata.finished_at = func.now()
         self.session.commit()
         logger.info(f"File {filepath} imported successfully.")
         return True
 
+    def batch_is_full(self) -> bool:
+        return (
+            self.current.batch_features >= self.batch_size
+            or self.current.batch_bytes >= self.batch_memory * 1024 * 1024
+        )
+
+    def flush_batch(self) -> None:
+        """Insert the pending city objects and relationships
+        and start a new batch."""
+        if self.current.unchanged is not None and self.current.features:
+            # the objects of the features that changed are replaced
+            self.delete_features(
+                [feature["feature_id"] for feature in self.current.features]
+            )
+
+        # the objects of a batch are stored in the order of their
+        # ground geometries, so that nearby objects are stored together
+        # even when the table is not clustered again
+        unique = None
+        if self.partition_key == PARTITION_KEYS["type"]:
+            # the unique constraint of the objects also holds their
+            # type, so an object id repeated with another type would
+            # not conflict
+            unique = ("cj_metadata_id", "object_id")
+        inserted = set(copy_lines(self.session,
+                                  CjObjectModel.__table__,
+                                  ROW_COLUMNS,
+                                  self.current.city_objects,
+                                  order_by="ground_geometry",
+                                  returning="id",
+                                  unique=unique))
+        self.added_objects += len(inserted)
+
+        # objects of a CityJSONFeature are never split across batches,
+        # so all the related objects exist at this point, except the
+        # ones skipped because their object id was already imported
+        families = [
+            family for family in self.current.families
+            if family["parent_id"] in inserted
+            and family["child_id"] in inserted
+        ]
+        if len(families) < len(self.current.families):
+            logger.warning("Skipped %s relationships of objects whose "
+                           "object id was already imported",
+                           len(self.current.families) - len(families))
+        copy_rows(self.session,
+                  CityObjectRelationshipModel.__table__,
+                  families)
+        copy_rows(self.session,
+                  CjFeatureModel.__table__,
+                  self.current.features)
+
+        # the progress is committed together with the batch,
+        # so that an interrupted import can be resumed after it
+        cj_metadata = self.current.cj_metadata
+        cj_metadata.imported_features = (
+            (cj_metadata.imported_features or 0)
+            + self.current.batch_features
+        )
+        cj_metadata.imported_bytes = self.current.position
+        if self.current.file_hash is not None:
+            cj_metadata.imported_hash = self.current.file_hash.hexdigest()
+        self.session.commit()
+
+        logger.debug("Flushed %s features to the database",
+                     self.current.batch_features)
+        self.current.city_objects = []
+        self.current.families = []
+        self.current.features = []
+        self.current.batch_features = 0
+        self.current.batch_bytes = 0
+
     def process_directory(self, dir_path) -> None:
         """Process all files in a directory."""
         logger.info("Running import for directory: %s", dir_path)
         ext = ".jsonl"
+        if self.jobs > 1:
+            files = [f for f in os.scandir(dir_path) if f.path.endswith(ext)]
+            self.process_files_in_parallel(files)
+            return
+
         for f in os.scandir(dir_path):
             if f.path.endswith(ext):
                 self.process_file(f.path)
 
+    def process_files_in_parallel(self, files) -> None:
+        """Imports the files concurrently, each in a separate
+        worker process with its own database connection.
+        The largest files are scheduled first, so that the import
+        does not end waiting for a single large file."""
+        files = sorted(files, key=lambda f: f.stat().st_size, reverse=True)
+        logger.info("Importing %s files with %s processes",
+                    len(files), self.jobs)
+
+        # do not keep a transaction open while the workers import
+        self.session.commit()
+        engine_url = self.engine.url.render_as_string(hide_password=False)
+        options = dict(
+            db_schema=self.db_schema,
+            input_srid=self.input_srid,
+            indexed_attributes=[],
+            partial_indexed_attributes=[],
+            ignore_repeated_file=self.ignore_repeated_file,
+            overwrite=self.overwrite,
+            transform=self.transform,
+            batch_size=self.batch_size,
+            batch_memory=self.batch_memory,
+            resume=self.resume,
+            update=self.update,
+            keep_templates=self.keep_templates,
+            storage=self.storage,
+            offline=self.offline,
+            extension_mirror=self.extension_mirror,
+            extension_ttl=self.extension_ttl,
+        )
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [
+                executor.submit(import_file_in_worker,
+                                engine_url,
+                                options,
+                                f.path)
+                for f in files
+            ]
+            for future in as_completed(futures):
+                # raises the exception if the import of a file failed
+                self.added_objects += future.result()
+
     def index_attributes(self):
         # postgres types to be used in type casted index
         postgres_type_mapping = {
@@ -476,7 +1055,7 @@ class Importer:
                     attr_name=attr_name,
                     attr_type=postgres_type,
                 )
-                with self.engine.connect() as conn:
+                with self.engine.begin() as conn:
                     conn.execute(text(cmd))
 
             else:
@@ -484,28 +1063,53 @@ class Importer:
                     f"Specified attribute to be indexed: '{attr_name}' does not exist"  # noqa
                 )
 
-    def get_geometries(
-        self, obj_id, cityobj, vertices, source_target_srid
-    ) -> Tuple[Optional[BaseGeometry], Optional[BaseGeometry]]:
-        if "geometry" not in cityobj:
-            return None, None
-
-        # returned geometry is already in the required projection
-        geometry = resolve_geometry_vertices(
-            cityobj["geometry"],
-            vertices,
-            self.current.cj_metadata.geometry_templates,
-            source_target_srid,
-        )
-
-        ground_geometry = get_ground_geometry(geometry, obj_id)
-
-        if ground_geometry is not None:
-            if not self.current.target_srid:
-                ground_geometry = func.st_geomfromtext(ground_geometry.wkt)
-            else:
-                ground_geometry = func.st_geomfromtext(
-                    ground_geometry.wkt, self.current.target_srid
-                )
 
-        return geometry, ground_geometry
+class FeatureReader:
+    """Iterates over the non-empty lines of a file. The position in the
+    file after each line and the empty lines skipped before it are
+    appended to pending, so that they can be looked up once the line
+    has been processed. The empty lines at the end are in skipped."""
+    def __init__(self, f, position):
+        self.f = f
+        self.position = position
+        self.pending = deque()
+        self.skipped = b""
+
+    def __iter__(self):
+        for line in self.f:
+            self.position += len(line)
+            if not line.strip():
+                self.skipped += line
+                continue
+            self.pending.append((self.position, self.skipped))
+            self.skipped = b""
+            yield line
+
+
+def is_index(statement) -> bool:
+    """Checks if an SQL statement creates an index."""
+    lines = [line for line in statement.splitlines()
+             if not line.strip().startswith("--")]
+    return " ".join(lines).strip().lower().startswith("create index")
+
+
+def import_file_in_worker(engine_url, options, filepath) -> int:
+    """Imports a single file in a worker process, with its own
+    database connection. The user cannot be prompted from
+    a worker process, so repeated files are skipped unless
+    --ignore-repeated-file or --overwrite are used.
+    Returns the number of city objects added."""
+    engine = create_engine(engine_url,
+                           json_serializer=dumps,
+                           json_deserializer=loads)
+    try:
+        with Importer(engine,
+                      filepath,
+                      interactive=False,
+                      **options) as imp:
+            # also finds the partition layout of the schema
+            imp.prepare_database()
+            imp.process_file(filepath)
+            return imp.added_objects
+    finally:
+        engine.dispose()
@@ -0,0 +1,137 @@
+import io
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+
+from sqlalchemy import Table
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.orm import Session
+
+from cjdb.modules.codec import dumps
+
+# characters that have to be escaped in the COPY text format
+COPY_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\r": "\\r",
+})
+COPY_NULL = "\\N"
+
+
+def format_copy_value(value: Any, column) -> str:
+    """Formats a single value as a field of the COPY text format."""
+    if value is None:
+        return COPY_NULL
+    if isinstance(column.type, JSONB):
+        value = dumps(value)
+    elif isinstance(column.type, ARRAY):
+        value = "{" + ",".join(map(str, value)) + "}"
+    else:
+        value = str(value)
+    return value.translate(COPY_ESCAPES)
+
+
+def format_copy_row(row: Dict[str, Any], columns) -> str:
+    """Formats a row as a line of the COPY text format,
+    without the line break."""
+    return "\t".join(format_copy_value(row.get(column.name), column)
+                     for column in columns)
+
+
+def lines_to_copy_buffer(lines: Iterable[str]) -> io.StringIO:
+    """Writes lines of the COPY text format to an in-memory buffer."""
+    buffer = io.StringIO()
+    for line in lines:
+        buffer.write(line)
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+def rows_to_copy_buffer(rows: List[Dict[str, Any]], columns) -> io.StringIO:
+    """Writes the rows in the COPY text format to an in-memory buffer."""
+    return lines_to_copy_buffer(format_copy_row(row, columns)
+                                for row in rows)
+
+
+def copy_rows(session: Session, table: Table,
+              rows: List[Dict[str, Any]],
+              order_by: Optional[str] = None) -> int:
+    """Bulk loads the rows into the table, see copy_lines.
+    Returns the number of inserted rows."""
+    if not rows:
+        return 0
+
+    columns = [c for c in table.columns if c.name in rows[0]]
+    return copy_lines(session, table, [c.name for c in columns],
+                      [format_copy_row(row, columns) for row in rows],
+                      order_by)
+
+
+def copy_lines(session: Session, table: Table,
+               column_names: Sequence[str], lines: List[str],
+               order_by: Optional[str] = None,
+               returning: Optional[str] = None,
+               unique: Optional[Sequence[str]] = None
+               ) -> Union[int, List[Any]]:
+    """Bulk loads rows already formatted as lines of the COPY text
+    format, with the given columns, into the table.
+    The rows are streamed with COPY ... FROM STDIN into a temporary
+    staging table and then merged into the table. Rows that conflict
+    with existing ones are skipped, like with ON CONFLICT DO NOTHING.
+    With order_by, the rows are merged in the order of that column,
+    so that they are stored close to each other in the table.
+    With unique, rows whose values of those columns are already in the
+    table or in the load are skipped too, for the tables that cannot
+    have that unique constraint, e.g. because of their partition key.
+    Returns the number of inserted rows, or with returning, the values
+    of that column of the inserted rows.
+    """
+    if not lines:
+        return [] if returning else 0
+
+    column_list = ", ".join(f'"{name}"' for name in column_names)
+    target = f"{table.schema}.{table.name}"
+    staging = f"{table.name}_staging"
+
+    cursor = session.connection().connection.cursor()
+    try:
+        # the staging table has the exact column types of the target
+        # table, but no constraints or indexes to maintain. It is
+        # created once per connection and emptied after every load.
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} AS "
+            f"SELECT * FROM {target} WITH NO DATA"
+        )
+        cursor.copy_expert(
+            f"COPY {staging} ({column_list}) FROM STDIN",
+            lines_to_copy_buffer(lines),
+        )
+        order = f'ORDER BY "{order_by}" ' if order_by else ""
+        returned = f' RETURNING "{returning}"' if returning else ""
+        source = staging
+        if unique:
+            unique_list = ", ".join(f'"{name}"' for name in unique)
+            matches = " AND ".join(f's."{name}" = t."{name}"'
+                                   for name in unique)
+            # like the conflicts, the first row in the order is kept
+            first = f', "{order_by}"' if order_by else ""
+            source = (
+                f"(SELECT DISTINCT ON ({unique_list}) * FROM {staging} "
+                f"ORDER BY {unique_list}{first}) s "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {target} t "
+                f"WHERE {matches})"
+            )
+        cursor.execute(
+            f"INSERT INTO {target} ({column_list}) "
+            f"SELECT {column_list} FROM {source} {order}"
+            f"ON CONFLICT DO NOTHING{returned}"
+        )
+        if returning:
+            inserted = [row[0] for row in cursor.fetchall()]
+        else:
+            inserted = cursor.rowcount
+        cursor.execute(f"TRUNCATE {staging}")
+    finally:
+        cursor.close()
+
+    return inserted
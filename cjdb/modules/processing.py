@@ -0,0 +1,295 @@
+import multiprocessing
+from collections import deque
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import shapely
+
+from cjdb.logger import logger
+from cjdb.model.sqlalchemy_models import CjObjectModel
+from cjdb.modules.checks import check_object_type
+from cjdb.modules.codec import loads
+from cjdb.modules.exceptions import InvalidLodException
+from cjdb.modules.geometric import (TemplateResolver, get_extent,
+                                    get_ground_geometry, get_vertices_extent,
+                                    reproject_vertices,
+                                    resolve_geometry_vertices,
+                                    transform_vertices)
+from cjdb.modules.loader import format_copy_row
+from cjdb.modules.storage import encode_geometry, fits_compact
+from cjdb.modules.utils import get_feature_hash
+
+# number of feature lines sent to a worker process at once
+CHUNK_SIZE = 16
+# number of chunks per worker that are read ahead from the input
+CHUNKS_IN_FLIGHT = 4
+
+# columns of the city object rows that are formatted for COPY when the
+# features are processed. The id and the cj_metadata_id of the rows
+# are only given when the rows are added to a batch.
+OBJECT_COLUMNS = ("object_id", "type", "attributes", "geometry",
+                  "vertices", "extent", "ground_geometry", "feature_id")
+
+
+# class to store what is needed to process the features of a file.
+# It is sent once to every worker process.
+class FeatureContext:
+    def __init__(self, transform, geometry_templates,
+                 source_srid, target_srid,
+                 city_object_types, extra_city_objects,
+                 keep_templates=False, storage="json"):
+        self.transform = transform
+        self.geometry_templates = geometry_templates
+        self.source_srid = source_srid
+        self.target_srid = target_srid
+        self.city_object_types = city_object_types
+        self.extra_city_objects = extra_city_objects
+        # the geometry instances are stored unexpanded, which is
+        # only possible when they are not reprojected
+        self.keep_templates = keep_templates and not self.source_target_srid
+        # the compact storage keeps the quantized vertices of the file,
+        # which is not possible when they are reprojected either
+        self.compact = storage == "compact" and not self.source_target_srid
+        # every worker process resolves the templates with its own cache,
+        # the compact storage keeps the instances unexpanded too
+        self.template_resolver = None
+        if geometry_templates:
+            self.template_resolver = TemplateResolver(
+                geometry_templates,
+                self.source_target_srid,
+                keep_instances=self.keep_templates or self.compact,
+            )
+        # key of the feature hashes, and the hashes of the features
+        # that did not change when updating an imported file
+        self.hash_key = b""
+        self.unchanged = frozenset()
+
+    @property
+    def source_target_srid(self) -> Optional[Tuple[int, int]]:
+        if self.target_srid != self.source_srid:
+            return self.source_srid, self.target_srid
+        return None
+
+
+def get_geometries(
+    obj_id, cityobj, vertices, context: FeatureContext, source_vertices=None
+) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str]]:
+    if "geometry" not in cityobj:
+        return None, None
+
+    # the GeometryInstances by their position in the geometry
+    instances = {
+        i: lod_level for i, lod_level in enumerate(cityobj["geometry"])
+        if lod_level["type"] == "GeometryInstance"
+    }
+    # returned geometry is already in the required projection
+    geometry = resolve_geometry_vertices(
+        cityobj["geometry"],
+        vertices,
+        context.template_resolver,
+        source_vertices,
+    )
+
+    if instances and not context.source_target_srid:
+        instance = get_lowest_instance(geometry,
+                                       instances,
+                                       context.template_resolver)
+        if instance is not None:
+            # the ground geometry of the template is moved to the anchor
+            # point, instead of being derived again for every instance
+            ground_geometry = context.template_resolver.get_ground_geometry(
+                instance, vertices[instance["boundaries"][0]], obj_id
+            )
+        else:
+            ground_geometry = get_ground_geometry(
+                [lod_level for i, lod_level in enumerate(geometry)
+                 if i not in instances],
+                obj_id
+            )
+    else:
+        ground_geometry = get_ground_geometry(geometry, obj_id)
+
+    # the ground geometry is loaded as hex encoded (E)WKB with COPY,
+    # which PostGIS reads without parsing text
+    if ground_geometry is not None:
+        if context.target_srid:
+            ground_geometry = shapely.set_srid(ground_geometry,
+                                               context.target_srid)
+        ground_geometry = shapely.to_wkb(ground_geometry,
+                                         hex=True,
+                                         include_srid=True)
+
+    return geometry, ground_geometry
+
+
+def get_lowest_instance(
+    geometry, instances, template_resolver
+) -> Optional[Dict[str, Any]]:
+    """Returns the GeometryInstance of the geometry with the minimum
+    LoD, if that geometry comes from a template. The LoD of the
+    instances is the one of their template, as they may not be
+    expanded."""
+    try:
+        lods = [
+            float(template_resolver.get_lod(instances[i])
+                  if i in instances else lod_level["lod"])
+            for i, lod_level in enumerate(geometry)
+        ]
+    except ValueError:
+        raise InvalidLodException()
+    return instances.get(lods.index(min(lods)))
+
+
+def process_feature(line_json, context: FeatureContext) -> List[Dict]:
+    """Turns a CityJSONFeature into city object rows.
+    The rows do not have database ids yet, instead every row
+    keeps the object ids of its children under 'children'."""
+    # unpack vertices for the cityobjects based on
+    # the CityJSON transform
+    # this is done once for the CityJSONFeature, as an (n, 3) array
+    vertices = transform_vertices(line_json["vertices"], context.transform)
+    compact_vertices = None
+    if context.compact:
+        compact_vertices = np.asarray(line_json["vertices"],
+                                      dtype=np.int64).reshape(-1, 3)
+        if not fits_compact(compact_vertices):
+            logger.warning("The vertices of feature %s are too large for "
+                           "the compact storage, its geometries are "
+                           "stored as json", line_json.get("id"))
+            compact_vertices = None
+    # the anchor points of the geometry templates are reprojected
+    # together with the template vertices
+    source_vertices = vertices
+
+    # reproject if needed
+    if context.source_target_srid:
+        vertices = reproject_vertices(vertices,
+                                      *context.source_target_srid)
+
+    city_objects = []
+    for obj_id, cityobj in line_json["CityObjects"].items():
+
+        # the compact geometry is encoded before the geometry is
+        # resolved, which replaces its boundaries
+        object_vertices = None
+        if compact_vertices is not None and "geometry" in cityobj:
+            compact_geometry, object_vertices = encode_geometry(
+                cityobj["geometry"], compact_vertices
+            )
+
+        # get 3D geom, ground geom and bbox
+        geometry, ground_geometry = get_geometries(
+            obj_id, cityobj, vertices, context, source_vertices
+        )
+        # the extent of the stored geometry, which gives
+        # the translate of the export
+        if object_vertices is not None:
+            geometry = compact_geometry
+            extent = get_vertices_extent(
+                transform_vertices(object_vertices, context.transform)
+            )
+        else:
+            extent = get_extent(geometry)
+
+        # check if the object type is allowed by the official
+        # spec or extension
+        check_result, message = check_object_type(
+            cityobj.get("type"),
+            context.city_object_types,
+            context.extra_city_objects,
+        )
+        if not check_result:
+            logger.info(message)
+
+        # 'or None' is added to change empty json "{}" to database null
+        city_objects.append({
+            "object_id": obj_id,
+            "type": cityobj.get("type"),
+            "attributes": cityobj.get("attributes") or None,
+            "geometry": geometry,
+            "vertices": object_vertices,
+            "extent": extent,
+            "ground_geometry": ground_geometry,
+            "feature_id": line_json.get("id"),
+            "children": cityobj.get("children", []),
+        })
+
+    return city_objects
+
+
+def encode_city_objects(
+    city_objects: List[Dict]
+) -> List[Tuple[str, List[str], str]]:
+    """Returns the object id, the object ids of the children and the
+    columns of OBJECT_COLUMNS formatted for COPY of every row."""
+    columns = [CjObjectModel.__table__.c[name] for name in OBJECT_COLUMNS]
+    return [
+        (row["object_id"], row["children"], format_copy_row(row, columns))
+        for row in city_objects
+    ]
+
+
+def process_line(
+    line: bytes, context: FeatureContext
+) -> Tuple[str, Optional[str], Optional[List[Tuple[str, List[str], str]]]]:
+    """Processes a feature line into the hash of the line, the id of
+    the feature and its encoded city objects (see encode_city_objects).
+    The features with the hash of an unchanged feature are not
+    processed, their id and objects are None."""
+    feature_hash = get_feature_hash(line, context.hash_key)
+    if feature_hash in context.unchanged:
+        return feature_hash, None, None
+    line_json = loads(line)
+    city_objects = encode_city_objects(process_feature(line_json, context))
+    return feature_hash, line_json.get("id"), city_objects
+
+
+# context of the worker process, set once when the worker starts
+_worker_context = None
+
+
+def init_worker(context: FeatureContext) -> None:
+    global _worker_context
+    _worker_context = context
+
+
+def process_line_in_worker(line: bytes) -> Tuple:
+    return process_line(line, _worker_context)
+
+
+def process_lines(
+    lines: Iterable[bytes], context: FeatureContext, jobs: int = 1
+) -> Iterator[Tuple[bytes, Tuple]]:
+    """Processes feature lines and yields each line together
+    with the result of process_line, in the order of the input.
+    With more than one job the lines are processed by a pool of
+    worker processes, which send back the rows already formatted for
+    COPY. Only a limited number of lines is read ahead, so the memory
+    use does not depend on the size of the input."""
+    if jobs <= 1:
+        for line in lines:
+            yield line, process_line(line, context)
+        return
+
+    lines = iter(lines)
+    window_size = jobs * CHUNK_SIZE * CHUNKS_IN_FLIGHT
+    with multiprocessing.Pool(jobs,
+                              initializer=init_worker,
+                              initargs=(context,)) as pool:
+        # keep the next window of lines in the pool while
+        # the results of the current one are consumed
+        pending = deque()
+        while True:
+            while len(pending) < 2:
+                window = list(islice(lines, window_size))
+                if not window:
+                    break
+                results = pool.imap(process_line_in_worker,
+                                    window,
+                                    CHUNK_SIZE)
+                pending.append((window, results))
+            if not pending:
+                break
+            window, results = pending.popleft()
+            yield from zip(window, results)
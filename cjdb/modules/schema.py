@@ -0,0 +1,162 @@
+"""Creation, layout and migration of the tables of a cjdb schema."""
+import re
+from typing import Optional
+
+from sqlalchemy import Table, text
+
+from cjdb.resources import object_types
+
+# partition layouts of the city object tables and their partition keys
+PARTITION_KEYS = {
+    "file": "cj_metadata_id",
+    "type": "type",
+}
+
+
+def table_exists(conn, schema, table_name) -> bool:
+    return conn.execute(
+        text("SELECT to_regclass(:table) IS NOT NULL"),
+        {"table": f"{schema}.{table_name}"}
+    ).scalar()
+
+
+def get_partition_key(conn, schema, table_name) -> Optional[str]:
+    """Returns the column a table is partitioned by,
+    or None if the table is not partitioned."""
+    definition = conn.execute(
+        text("SELECT pg_get_partkeydef(to_regclass(:table))"),
+        {"table": f"{schema}.{table_name}"}
+    ).scalar()
+    if not definition:
+        return None
+    # e.g. "LIST (cj_metadata_id)"
+    return re.search(r"\((.*)\)", definition).group(1).strip('"')
+
+
+def create_partitioned_tables(conn, schema, layout) -> None:
+    """Creates the city object tables for a partitioned layout.
+    Only the key columns and constraints are created here, the other
+    columns are added from the models with add_missing_columns.
+    PostgreSQL requires the partition key in the primary key and the
+    unique constraints of a partitioned table.
+
+    With the 'file' layout, the relationships are partitioned too and
+    reference the objects by their id and cj_metadata_id.
+    With the 'type' layout, the relationships cannot reference the
+    objects by id alone, so they are removed with their file through
+    their cj_metadata_id instead."""
+    key = PARTITION_KEYS[layout]
+    unique_key = "cj_metadata_id, object_id"
+    if key != "cj_metadata_id":
+        unique_key += f", {key}"
+    conn.execute(text(f"""
+        CREATE TABLE {schema}.city_object (
+            id serial NOT NULL,
+            cj_metadata_id integer NOT NULL
+                REFERENCES {schema}.cj_metadata (id) ON DELETE CASCADE,
+            object_id varchar NOT NULL,
+            type varchar NOT NULL,
+            PRIMARY KEY (id, {key}),
+            UNIQUE ({unique_key})
+        ) PARTITION BY LIST ({key})"""))
+
+    if layout == "file":
+        conn.execute(text(f"""
+            CREATE TABLE {schema}.city_object_relationships (
+                id serial NOT NULL,
+                cj_metadata_id integer NOT NULL
+                    REFERENCES {schema}.cj_metadata (id) ON DELETE CASCADE,
+                parent_id integer,
+                child_id integer,
+                PRIMARY KEY (id, cj_metadata_id),
+                UNIQUE (parent_id, child_id, cj_metadata_id),
+                FOREIGN KEY (parent_id, cj_metadata_id)
+                    REFERENCES {schema}.city_object (id, cj_metadata_id)
+                    ON DELETE CASCADE,
+                FOREIGN KEY (child_id, cj_metadata_id)
+                    REFERENCES {schema}.city_object (id, cj_metadata_id)
+                    ON DELETE CASCADE
+            ) PARTITION BY LIST (cj_metadata_id)"""))
+    else:
+        conn.execute(text(f"""
+            CREATE TABLE {schema}.city_object_relationships (
+                id serial PRIMARY KEY,
+                cj_metadata_id integer NOT NULL
+                    REFERENCES {schema}.cj_metadata (id) ON DELETE CASCADE,
+                parent_id integer,
+                child_id integer,
+                UNIQUE (parent_id, child_id)
+            )"""))
+        create_type_partitions(conn, schema)
+
+
+def create_type_partitions(conn, schema) -> None:
+    """Creates a partition of the city objects for every first level
+    CityObject type, holding also its second level types (e.g.
+    Building, BuildingPart, BuildingInstallation...). Objects of
+    other types, like those of extensions, go to a default partition.
+    """
+    for parent_type, child_types in object_types.types.items():
+        values = ", ".join(
+            f"'{object_type}'"
+            for object_type in [parent_type] + (child_types or [])
+        )
+        conn.execute(text(
+            f"CREATE TABLE {schema}.city_object_{parent_type.lower()} "
+            f"PARTITION OF {schema}.city_object FOR VALUES IN ({values})"
+        ))
+    conn.execute(text(
+        f"CREATE TABLE {schema}.city_object_other "
+        f"PARTITION OF {schema}.city_object DEFAULT"
+    ))
+
+
+def add_missing_columns(conn, table: Table) -> None:
+    """Adds the columns of the model that the table in the database
+    does not have, e.g. for schemas created by an older version.
+    The columns are added without their constraints."""
+    existing = set(conn.execute(
+        text("SELECT column_name FROM information_schema.columns "
+             "WHERE table_schema = :schema AND table_name = :table"),
+        {"schema": table.schema, "table": table.name}
+    ).scalars())
+    for column in table.columns:
+        if column.name not in existing:
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(
+                f"ALTER TABLE {table.schema}.{table.name} "
+                f'ADD COLUMN IF NOT EXISTS "{column.name}" {column_type}'
+            ))
+
+
+def file_partition_names(cj_metadata_id):
+    """Returns the partitions of the city object tables that hold
+    the objects of an imported file, in the order they are created."""
+    return [
+        ("city_object", f"city_object_file_{cj_metadata_id}"),
+        ("city_object_relationships",
+         f"city_object_relationships_file_{cj_metadata_id}"),
+    ]
+
+
+def create_file_partitions(conn, schema, cj_metadata_id) -> None:
+    for parent, partition in file_partition_names(cj_metadata_id):
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {schema}.{partition} "
+            f"PARTITION OF {schema}.{parent} "
+            f"FOR VALUES IN ({int(cj_metadata_id)})"
+        ))
+
+
+def drop_file_partitions(conn, schema, cj_metadata_id) -> None:
+    """Removes the objects of an imported file by dropping their
+    partitions, instead of deleting them row by row. The partitions
+    are detached first, as the one of the city objects is referenced
+    by the relationships."""
+    for parent, partition in reversed(file_partition_names(cj_metadata_id)):
+        if table_exists(conn, schema, partition):
+            conn.execute(text(
+                f"ALTER TABLE {schema}.{parent} "
+                f"DETACH PARTITION {schema}.{partition}"
+            ))
+            conn.execute(text(f"DROP TABLE {schema}.{partition}"))
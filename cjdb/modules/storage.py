@@ -0,0 +1,78 @@
+"""Encoding of the geometries of the city objects for storage.
+
+With the 'json' format, the geometries are stored with the coordinates
+of their vertices in the boundaries. With the 'compact' format, the
+boundaries keep the vertex indices, like in CityJSON, and the vertices
+of the object are stored separately as an integer array, quantized with
+the transform of their file."""
+from itertools import chain
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from cjdb.modules.geometric import get_rings, replace_rings, resolve
+
+STORAGE_FORMATS = ("json", "compact")
+
+# the compact vertices are stored as a PostgreSQL integer[]
+MAX_VERTEX_VALUE = 2 ** 31 - 1
+
+
+def fits_compact(vertices: np.ndarray) -> bool:
+    """Checks if quantized vertices fit in the integer array."""
+    return vertices.size == 0 or np.abs(vertices).max() <= MAX_VERTEX_VALUE
+
+
+def encode_geometry(
+    geometry: List[Dict[str, Any]], vertices: np.ndarray
+) -> Tuple[List[Dict[str, Any]], List[int]]:
+    """Returns a copy of the geometries of a city object whose vertex
+    indices refer only to the vertices it uses, together with those
+    vertices, quantized and flattened (x, y, z, x, y, z...)."""
+    rings = [get_rings(lod_level["boundaries"]) for lod_level in geometry]
+    indices = np.fromiter(chain.from_iterable(chain.from_iterable(rings)),
+                          dtype=np.intp)
+    used, remapped = np.unique(indices, return_inverse=True)
+    remapped = remapped.tolist()
+
+    ends = np.cumsum([len(ring) for ring in chain.from_iterable(rings)])
+    starts = [0] + ends[:-1].tolist()
+    remapped_rings = (remapped[start:end]
+                      for start, end in zip(starts, ends.tolist()))
+    encoded = [
+        {**lod_level,
+         "boundaries": replace_rings(lod_level["boundaries"], remapped_rings)}
+        for lod_level in geometry
+    ]
+    return encoded, np.asarray(vertices)[used].ravel().tolist()
+
+
+def decode_vertices(vertices: List[int], transform) -> np.ndarray:
+    """Returns the coordinates of compact vertices, as an (n, 3) array."""
+    array = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    return array * transform["scale"] + transform["translate"]
+
+
+def decode_geometry(
+    geometry: List[Dict[str, Any]], vertices: List[int], transform
+) -> List[Dict[str, Any]]:
+    """Returns the geometries of a city object stored in the compact
+    format as they are stored in the json format. Geometry instances
+    get the coordinates of their anchor point."""
+    coordinates = decode_vertices(vertices, transform)
+    return [resolve(lod_level, coordinates, inplace=False)
+            for lod_level in geometry]
+
+
+def requantize_vertices(
+    vertices: List[int], transform, scale: List[float],
+    translate: List[float]
+) -> List[List[int]]:
+    """Returns compact vertices quantized with another transform, as
+    (x, y, z) lists. The integers are mapped from one transform to the
+    other and rounded once, without going through their coordinates
+    rounded to the decimals of the other scale."""
+    array = np.asarray(vertices, dtype=np.int64).reshape(-1, 3)
+    shift = np.subtract(transform["translate"], translate)
+    requantized = np.rint((array * transform["scale"] + shift) / scale)
+    return requantized.astype(np.int64).tolist()
@@ -1,8 +1,11 @@
-from typing import Any, Dict
+import hashlib
+import json
+from typing import Any, Dict, Optional, Union
 
 import psycopg2
 from sqlalchemy import create_engine
 
+from cjdb.modules.codec import dumps, loads
 from cjdb.resources import object_types
 
 
@@ -18,7 +21,10 @@ def get_db_engine(db_user, db_password, db_host, db_port, db_name, echo=False):
         f"postgresql://{db_user}:{db_password}"
         f"@{db_host}:{db_port}/{db_name}"
     )
-    engine = create_engine(conn_string, echo=echo)
+    engine = create_engine(conn_string,
+                           echo=echo,
+                           json_serializer=dumps,
+                           json_deserializer=loads)
     return engine
 
 def get_db_psycopg_conn(db_user, db_password, db_host, db_port, db_name):
@@ -67,6 +73,56 @@ def find_extra_properties(json_obj):
     return property_names
 
 
+def get_hash_key(settings) -> bytes:
+    """Returns a key for get_file_hash and get_feature_hash
+    from the JSON serializable settings of an import. The settings are
+    serialized with the standard json module, whose output does not
+    depend on the codec that is installed."""
+    serialized = json.dumps(settings, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(serialized.encode(), digest_size=32).digest()
+
+
+def new_file_hash(key: bytes = b""):
+    """Returns the hash object of get_file_hash, to hash the content
+    of a file while it is read."""
+    return hashlib.blake2b(key=key)
+
+
+def hash_file(filepath: str, key: bytes = b"", size: Optional[int] = None):
+    """Returns the hash object of the first size bytes of a file,
+    or of the whole file."""
+    file_hash = new_file_hash(key)
+    remaining = size
+    with open(filepath, "rb") as f:
+        while remaining is None or remaining > 0:
+            chunk_size = 1024 * 1024
+            if remaining is not None:
+                chunk_size = min(chunk_size, remaining)
+                remaining -= chunk_size
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+    return file_hash
+
+
+def get_file_hash(filepath: str, key: bytes = b"") -> str:
+    """Returns a hash of the content of a file. The key is
+    hashed with the content, e.g. the settings of the import."""
+    return hash_file(filepath, key).hexdigest()
+
+
+def get_feature_hash(line: Union[bytes, str], key: bytes = b"") -> str:
+    """Returns a hash of a CityJSONFeature line. The vertices of a
+    feature depend on the transform of its file, which is hashed
+    in the key."""
+    if isinstance(line, str):
+        line = line.encode()
+    return hashlib.blake2b(line.strip(),
+                           digest_size=16,
+                           key=key).hexdigest()
+
+
 # Sqlalchemy model as dict
 def to_dict(model):
     d = dict(model.__dict__)
@@ -0,0 +1,70 @@
+-- decoding of the geometries stored in the compact format:
+-- the boundaries hold vertex indices into the vertices column,
+-- which holds the quantized x, y, z of each vertex
+
+-- coordinates of a single vertex, with the transform of its file
+CREATE OR REPLACE FUNCTION {schema}.cj_decode_vertex(
+    vertex_index integer, vertices integer[], transform jsonb
+) RETURNS jsonb
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT jsonb_build_array(
+        vertices[vertex_index * 3 + 1] * (transform->'scale'->>0)::float8
+            + (transform->'translate'->>0)::float8,
+        vertices[vertex_index * 3 + 2] * (transform->'scale'->>1)::float8
+            + (transform->'translate'->>1)::float8,
+        vertices[vertex_index * 3 + 3] * (transform->'scale'->>2)::float8
+            + (transform->'translate'->>2)::float8
+    )
+$$;
+
+-- boundaries with the coordinates of their vertices
+CREATE OR REPLACE FUNCTION {schema}.cj_decode_boundaries(
+    boundaries jsonb, vertices integer[], transform jsonb
+) RETURNS jsonb
+LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE AS $$
+BEGIN
+    IF jsonb_typeof(boundaries) = 'number' THEN
+        RETURN {schema}.cj_decode_vertex(
+            boundaries::integer, vertices, transform
+        );
+    ELSIF jsonb_typeof(boundaries) = 'array' THEN
+        RETURN (
+            SELECT coalesce(
+                jsonb_agg(
+                    {schema}.cj_decode_boundaries(b, vertices, transform)
+                    ORDER BY position
+                ),
+                '[]'::jsonb
+            )
+            FROM jsonb_array_elements(boundaries)
+                WITH ORDINALITY AS elements(b, position)
+        );
+    END IF;
+    RETURN boundaries;
+END
+$$;
+
+-- geometry of a city object as it is stored in the json format,
+-- e.g. cj_decode_geometry(co.geometry, co.vertices, m.transform)
+CREATE OR REPLACE FUNCTION {schema}.cj_decode_geometry(
+    geometry jsonb, vertices integer[], transform jsonb
+) RETURNS jsonb
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT CASE
+        WHEN vertices IS NULL OR geometry IS NULL THEN geometry
+        ELSE (
+            SELECT jsonb_agg(
+                jsonb_set(
+                    g,
+                    ARRAY['boundaries'],
+                    {schema}.cj_decode_boundaries(
+                        g->'boundaries', vertices, transform
+                    )
+                )
+                ORDER BY position
+            )
+            FROM jsonb_array_elements(geometry)
+                WITH ORDINALITY AS elements(g, position)
+        )
+    END
+$$;
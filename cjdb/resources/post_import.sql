@@ -8,7 +8,9 @@ CREATE INDEX IF NOT EXISTS city_object_type_idx ON {schema}.city_object USING bt
 
 CREATE INDEX IF NOT EXISTS city_object_ground_gix ON {schema}.city_object USING gist(ground_geometry);
 
-CREATE INDEX lod ON {schema}.city_object USING gin (geometry);
+CREATE INDEX IF NOT EXISTS lod ON {schema}.city_object USING gin (geometry);
+
+CREATE INDEX IF NOT EXISTS city_object_feature_idx ON {schema}.city_object USING btree(cj_metadata_id, feature_id);
 
 -- city_object_relationships indexes
 CREATE INDEX IF NOT EXISTS city_object_relationships_parent_idx ON {schema}.city_object_relationships USING btree(parent_id);
@@ -16,6 +18,4 @@ CREATE INDEX IF NOT EXISTS city_object_relationships_parent_idx ON {schema}.city
 CREATE INDEX IF NOT EXISTS city_object_relationships_child_idx ON {schema}.city_object_relationships USING btree(child_id);
 
 -- clustering
-cluster {schema}.cj_metadata USING cj_metadata_gix;
-
-cluster {schema}.city_object USING city_object_ground_gix;
\ No newline at end of file
+cluster {schema}.cj_metadata USING cj_metadata_gix;
\ No newline at end of file
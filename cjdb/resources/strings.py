@@ -52,10 +52,129 @@ overwrite_help = (
 transform_help = ("Transform input geometries to the CRS "
                   "of the existing schema")
 
+batch_size_help = (
+    "Number of CityJSONFeatures to keep in memory before they are "
+    "written to the database."
+)
+
+batch_memory_help = (
+    "Amount of input (in MB) to keep in memory before it is "
+    "written to the database. Whichever of --batch-size and "
+    "--batch-memory is reached first triggers the write."
+)
+
+jobs_help = (
+    "Number of processes used for the import. For a single file, "
+    "the CityJSONFeatures are processed in parallel and still "
+    "written to the database in the order of the input. For a "
+    "directory, the files are imported concurrently, each with its "
+    "own database connection. Previously imported files cannot be "
+    "confirmed interactively then, so they are skipped unless "
+    "--ignore-repeated-file or --overwrite is used."
+)
+
+bulk_help = (
+    "Bulk load mode: drop the secondary indexes of the city object "
+    "tables before the import and rebuild them in parallel "
+    "afterwards. Faster when adding many objects to a populated "
+    "schema. Do not use it while other imports run on the schema."
+)
+
+maintenance_work_mem_help = (
+    "Memory (in MB) that PostgreSQL can use for each index build and "
+    "for the clustering after the import (maintenance_work_mem). "
+    "Up to 4 indexes are built at the same time."
+)
+
+maintenance_workers_help = (
+    "Number of parallel workers that PostgreSQL can use for each index "
+    "build and for the clustering after the import "
+    "(max_parallel_maintenance_workers). Default: the setting of the "
+    "server."
+)
+
+cluster_threshold_help = (
+    "The city object table is clustered on the ground geometries "
+    "after an import that added at least this fraction of its rows "
+    "(0 to 1). Clustering rewrites the whole table, so small imports "
+    "skip it. Use 0 to always cluster."
+)
+
+partition_help = (
+    "Partition the city object tables of a new schema. With 'file', "
+    "the objects of every imported file are stored in their own "
+    "partitions, so overwriting a file drops its partitions instead "
+    "of deleting its objects one by one. With 'type', the objects "
+    "are partitioned by their (first level) CityObject type, so that "
+    "queries on a type only read its partition. An existing schema "
+    "keeps its layout."
+)
+
+resume_help = (
+    "Resume interrupted imports: files that were imported completely "
+    "are skipped and unfinished files continue after the last batch "
+    "written to the database. Unfinished files that changed since are "
+    "imported again from the start."
+)
+
+update_help = (
+    "Update files that were imported before: only the features that "
+    "were added or changed since are imported, and the features that "
+    "are not in the file anymore are removed. Files that did not "
+    "change are always skipped."
+)
+
+keep_templates_help = (
+    "Store the geometry instances with their template index, "
+    "transformation matrix and anchor point, instead of expanding "
+    "them with the geometry templates of their file. Instances that "
+    "are reprojected are always expanded."
+)
+
+storage_help = (
+    "Storage format of the geometries. With 'json', the boundaries "
+    "hold the coordinates of their vertices. With 'compact', they keep "
+    "the vertex indices and the vertices of every object are stored "
+    "as integers with the transform of their file, which takes less "
+    "space. Geometries that are reprojected are always stored as json."
+)
+
+offline_help = (
+    "Do not download the schemas of the extensions: only the "
+    "--extension-mirror and the extension cache are used, even when "
+    "the cached schemas are older than --extension-ttl."
+)
+
+extension_mirror_help = (
+    "Local directory or file:// url to read the schemas of the "
+    "extensions from, instead of downloading them. A schema is read "
+    "from the file with the name of its url, e.g. 'noise.ext.json'."
+)
+
+extension_ttl_help = (
+    "Number of hours the downloaded schemas of the extensions are "
+    "kept in the cache ($CJDB_CACHE_DIR, by default ~/.cache/cjdb) "
+    "before they are downloaded again. Default: 24."
+)
+
 output_help = (
     "Name of the output file. Default name: 'cj_export.city.json' "
 )
 
+itersize_help = (
+    "Number of rows fetched at once from the database. The objects are "
+    "streamed and every feature is written as soon as its objects "
+    "have been fetched, so the memory use depends on this number "
+    "and not on the size of the export. Default: 2000."
+)
+
+export_jobs_help = (
+    "Number of processes assembling and serializing the features, "
+    "each with its own database connection. All the connections read "
+    "the same snapshot of the database, and the features are written "
+    "in the same order as with a single process. Default: 1."
+)
+
 query_help = (
     "SQL query with the ids of the objects to be exported."
 )
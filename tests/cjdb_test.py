@@ -1,10 +1,12 @@
 import io
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from pytest_postgresql.janitor import DatabaseJanitor
-from sqlalchemy import MetaData, Table, create_engine, inspect, select
+from sqlalchemy import MetaData, Table, create_engine, inspect, select, text
 from sqlalchemy.orm import Session
 
+from cjdb.modules.codec import dumps, loads
 from cjdb.modules.exceptions import (InconsistentCRSException,
                                      InvalidCityJSONObjectException,
                                      InvalidMetadataException,
@@ -31,6 +33,48 @@ def engine_postgresql(postgresql_proc):
         )
 
 
+@pytest.fixture(scope="module")
+def batches(engine_postgresql):
+    """Schema with vienna.jsonl imported in batches, which the tests of
+    the export read."""
+    import_file(engine_postgresql, "batches", batch_size=10)
+    return "batches"
+
+
+def import_file(engine, db_schema, filepath="./tests/files/vienna.jsonl",
+                input_srid=4326, **options) -> Importer:
+    """Imports a file with the default options, and returns the
+    importer."""
+    options = {
+        "indexed_attributes": [],
+        "partial_indexed_attributes": [],
+        "ignore_repeated_file": False,
+        "overwrite": False,
+        "transform": False,
+        **options,
+    }
+    with Importer(engine=engine,
+                  filepath=str(filepath),
+                  db_schema=db_schema,
+                  input_srid=input_srid,
+                  **options) as importer:
+        importer.run_import()
+    return importer
+
+
+def export_schema(engine, schema, output, sqlquery=None, **options):
+    """Exports a schema, and returns the lines of the output as json."""
+    conn = engine.raw_connection()
+    with Exporter(connection=conn,
+                  schema=schema,
+                  sqlquery=sqlquery,
+                  output=str(output),
+                  **options) as exporter:
+        exporter.run_export()
+    with open(output) as f:
+        return [loads(line) for line in f]
+
+
 def test_single_import_missing_srid(engine_postgresql):
     with Importer(
         engine=engine_postgresql,
@@ -481,4 +525,433 @@ def test_single_import_cj_version_2(
         overwrite=False,
         transform=False
     ) as importer:
-        importer.run_import()
\ No newline at end of file
+        importer.run_import()
+
+
+def test_import_in_batches(engine_postgresql, batches):
+    city_object = Table(
+        "city_object", MetaData(), schema=batches,
+        autoload_with=engine_postgresql
+    )
+    relationships = Table(
+        "city_object_relationships", MetaData(), schema=batches,
+        autoload_with=engine_postgresql
+    )
+
+    with Session(engine_postgresql) as session:
+        assert session.query(city_object).count() == 592
+        assert session.query(relationships).count() == 443
+
+
+def test_export_streaming(engine_postgresql, batches, tmp_path):
+    metadata, *features = export_schema(engine_postgresql, batches,
+                                        tmp_path / "exported.jsonl",
+                                        itersize=7)
+    object_ids = [object_id for feature in features
+                  for object_id in feature["CityObjects"]]
+    assert len(object_ids) == len(set(object_ids)) == 592
+
+    # the translate is the minimum of the extents of the objects
+    with engine_postgresql.connect() as conn:
+        missing, *minimum = conn.execute(text("""
+            SELECT count(*) FILTER (WHERE extent IS NULL
+                                    AND geometry IS NOT NULL),
+                   min(extent[1]), min(extent[2]), min(extent[3])
+            FROM batches.city_object""")).one()
+    assert missing == 0
+    assert metadata["transform"]["translate"] == minimum
+    assert all(feature["id"] in feature["CityObjects"]
+               for feature in features)
+
+
+def test_export_with_jobs(engine_postgresql, batches, tmp_path):
+    parallel = export_schema(engine_postgresql, batches,
+                             tmp_path / "exported_jobs.jsonl", jobs=3)
+    # the same output as with a single process
+    assert parallel == export_schema(engine_postgresql, batches,
+                                     tmp_path / "exported.jsonl")
+
+
+def test_export_query(engine_postgresql, batches, tmp_path):
+    # the ids of children and repeated ids do not add features
+    exported = export_schema(
+        engine_postgresql, batches, tmp_path / "exported.jsonl",
+        sqlquery="""SELECT object_id FROM batches.city_object
+                    UNION ALL
+                    SELECT object_id FROM batches.city_object"""
+    )
+
+    with engine_postgresql.connect() as conn:
+        roots = conn.execute(text("""
+            SELECT count(*) FROM batches.city_object co
+            WHERE NOT EXISTS (
+                SELECT 1 FROM batches.city_object_relationships r
+                WHERE r.child_id = co.id)""")).scalar()
+    assert len(exported) == roots + 1
+
+
+def test_import_with_jobs(engine_postgresql, batches):
+    import_file(engine_postgresql, "jobs", jobs=2)
+
+    with Session(engine_postgresql) as session:
+        parallel = session.execute(
+            text("SELECT object_id, id FROM jobs.city_object ORDER BY id")
+        ).all()
+        sequential = session.execute(
+            text("SELECT object_id, id FROM batches.city_object ORDER BY id")
+        ).all()
+    assert len(parallel) == 592
+    assert parallel == sequential
+
+
+def test_directory_import_with_jobs(engine_postgresql):
+    import_file(engine_postgresql, "parallel_files", "./tests/files/cjfiles",
+                input_srid=None, jobs=2)
+
+    with Session(engine_postgresql) as session:
+        finished = session.execute(
+            text("SELECT count(*) FROM parallel_files.cj_metadata "
+                 "WHERE finished_at IS NOT NULL")
+        ).scalar()
+        ids = session.execute(
+            text("SELECT count(*), count(DISTINCT id) "
+                 "FROM parallel_files.city_object")
+        ).one()
+    assert finished == 2
+    assert ids[0] == ids[1] == 213
+
+
+def test_concurrent_imports(engine_postgresql):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(import_file, engine_postgresql, "concurrent",
+                            filepath, input_srid=None,
+                            ignore_repeated_file=True, batch_size=10)
+            for filepath in ["./tests/files/cjfiles/5870_ext.jsonl",
+                             "./tests/files/cjfiles/tile_901_trimmed.jsonl"]
+        ]
+        for future in futures:
+            future.result()
+
+    with Session(engine_postgresql) as session:
+        ids = session.execute(
+            text("SELECT count(*), count(DISTINCT id) "
+                 "FROM concurrent.city_object")
+        ).one()
+    assert ids[0] == ids[1] == 213
+
+
+def test_bulk_import(engine_postgresql):
+    importer = import_file(engine_postgresql, "bulk", bulk=True)
+    assert importer.added_objects == 592
+
+    with engine_postgresql.connect() as conn:
+        indexes = conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = 'bulk'"
+        )).scalars().all()
+        count = conn.execute(text(
+            "SELECT count(*) FROM bulk.city_object"
+        )).scalar()
+    assert "city_object_ground_gix" in indexes
+    assert "lod" in indexes
+    assert "city_object_relationships_parent_idx" in indexes
+    assert count == 592
+
+
+def test_bulk_import_partitioned(engine_postgresql):
+    # the second import drops and rebuilds the indexes
+    for _ in range(2):
+        import_file(engine_postgresql, "bulk_partitioned", overwrite=True,
+                    bulk=True, partition="type")
+
+    with engine_postgresql.connect() as conn:
+        invalid = conn.execute(text("""
+            SELECT count(*) FROM pg_index
+            JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+            JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+            WHERE pg_namespace.nspname = 'bulk_partitioned'
+            AND NOT pg_index.indisvalid""")).scalar()
+        partition_indexes = conn.execute(text(
+            "SELECT indexdef FROM pg_indexes "
+            "WHERE schemaname = 'bulk_partitioned' "
+            "AND tablename = 'city_object_building'"
+        )).scalars().all()
+    assert invalid == 0
+    assert any("gist (ground_geometry)" in index
+               for index in partition_indexes)
+    assert any("gin (geometry)" in index for index in partition_indexes)
+    assert any("btree (type)" in index for index in partition_indexes)
+
+
+def test_partition_by_file(engine_postgresql):
+    for _ in range(2):
+        import_file(engine_postgresql, "partitioned", overwrite=True,
+                    partition="file")
+
+    with engine_postgresql.connect() as conn:
+        cj_metadata_id = conn.execute(text(
+            "SELECT id FROM partitioned.cj_metadata"
+        )).scalar_one()
+        partitions = conn.execute(text(
+            "SELECT inhrelid::regclass::text FROM pg_inherits "
+            "WHERE inhparent = 'partitioned.city_object'::regclass"
+        )).scalars().all()
+        count = conn.execute(text(
+            "SELECT count(*) FROM partitioned.city_object"
+        )).scalar()
+        relationships = conn.execute(text(
+            "SELECT count(*) FROM partitioned.city_object_relationships"
+        )).scalar()
+    assert partitions == [f"partitioned.city_object_file_{cj_metadata_id}"]
+    assert count == 592
+    assert relationships == 443
+
+
+def test_partition_by_type(engine_postgresql, tmp_path):
+    import_file(engine_postgresql, "partitioned_type", partition="type")
+
+    with engine_postgresql.connect() as conn:
+        buildings = conn.execute(text(
+            "SELECT count(*) FROM partitioned_type.city_object_building"
+        )).scalar()
+        count = conn.execute(text(
+            "SELECT count(*) FROM partitioned_type.city_object "
+            "WHERE type IN ('Building', 'BuildingPart')"
+        )).scalar()
+    assert buildings == count
+    assert count > 0
+
+    metadata, *features = export_schema(engine_postgresql,
+                                        "partitioned_type",
+                                        tmp_path / "exported.jsonl")
+    assert sum(len(feature["CityObjects"]) for feature in features) == 592
+
+
+def test_partition_by_type_repeated_object_id(engine_postgresql, tmp_path):
+    with open("./tests/files/vienna.jsonl") as f:
+        metadata, first = f.readline(), f.readline()
+    city_objects = loads(first)["CityObjects"]
+    object_id = next(iter(city_objects))
+    # the same object id again, with another type
+    repeated = {
+        "type": "CityJSONFeature",
+        "id": "repeated",
+        "CityObjects": {object_id: {"type": "GenericCityObject"}},
+        "vertices": [],
+    }
+    filepath = tmp_path / "repeated.jsonl"
+    filepath.write_text(metadata + first + dumps(repeated) + "\n")
+    import_file(engine_postgresql, "partitioned_repeated", filepath,
+                partition="type")
+
+    with engine_postgresql.connect() as conn:
+        types = conn.execute(text(
+            "SELECT type FROM partitioned_repeated.city_object "
+            "WHERE object_id = :object_id"
+        ), {"object_id": object_id}).scalars().all()
+    assert types == [city_objects[object_id]["type"]]
+
+
+def test_resume_import(engine_postgresql, monkeypatch):
+    flush_batch = Importer.flush_batch
+    flushes = []
+
+    def interrupted_flush_batch(self):
+        flushes.append(self.current.batch_features)
+        if len(flushes) == 3:
+            raise RuntimeError("Import interrupted")
+        flush_batch(self)
+
+    monkeypatch.setattr(Importer, "flush_batch", interrupted_flush_batch)
+    with pytest.raises(RuntimeError):
+        import_file(engine_postgresql, "resume", batch_size=10)
+    monkeypatch.undo()
+
+    import_file(engine_postgresql, "resume", batch_size=10, resume=True)
+    # a finished file is skipped
+    import_file(engine_postgresql, "resume", batch_size=10, resume=True)
+
+    with open("./tests/files/vienna.jsonl") as f:
+        features = sum(1 for line in f if line.strip()) - 1
+    with engine_postgresql.connect() as conn:
+        imports = conn.execute(text(
+            "SELECT imported_features, finished_at FROM resume.cj_metadata"
+        )).all()
+        count = conn.execute(text(
+            "SELECT count(*) FROM resume.city_object"
+        )).scalar()
+    assert len(imports) == 1
+    assert imports[0].imported_features == features
+    assert imports[0].finished_at is not None
+    assert count == 592
+
+
+def test_resume_changed_file(engine_postgresql, monkeypatch, tmp_path):
+    flush_batch = Importer.flush_batch
+    flushes = []
+
+    def interrupted_flush_batch(self):
+        flushes.append(self.current.batch_features)
+        if len(flushes) == 3:
+            raise RuntimeError("Import interrupted")
+        flush_batch(self)
+
+    with open("./tests/files/vienna.jsonl", "rb") as f:
+        lines = f.readlines()
+    filepath = tmp_path / "vienna.jsonl"
+    filepath.write_bytes(b"".join(lines))
+    monkeypatch.setattr(Importer, "flush_batch", interrupted_flush_batch)
+    with pytest.raises(RuntimeError):
+        import_file(engine_postgresql, "resume_changed", filepath,
+                    batch_size=10)
+    monkeypatch.undo()
+
+    # the file loses its first features before the import is resumed
+    features = [line for line in lines[1:] if line.strip()]
+    filepath.write_bytes(b"".join([lines[0]] + features[5:]))
+    import_file(engine_postgresql, "resume_changed", filepath,
+                batch_size=10, resume=True)
+
+    with engine_postgresql.connect() as conn:
+        imports = conn.execute(text(
+            "SELECT imported_features, finished_at "
+            "FROM resume_changed.cj_metadata"
+        )).all()
+        count = conn.execute(text(
+            "SELECT count(*) FROM resume_changed.city_object"
+        )).scalar()
+    assert len(imports) == 1
+    assert imports[0].imported_features == len(features) - 5
+    assert imports[0].finished_at is not None
+    assert count == sum(len(loads(line)["CityObjects"])
+                        for line in features[5:])
+
+
+def test_update_import(engine_postgresql, tmp_path):
+    with open("./tests/files/vienna.jsonl", "rb") as f:
+        lines = f.readlines()
+    # the first version of the file misses its last features
+    # and has one changed feature
+    features = [line for line in lines[1:] if line.strip()]
+    changed = loads(features[0])
+    changed["CityObjects"][next(iter(changed["CityObjects"]))][
+        "attributes"] = {"changed": True}
+    filepath = tmp_path / "vienna.jsonl"
+    filepath.write_bytes(b"".join(
+        [lines[0], dumps(changed).encode() + b"\n"] + features[1:-5]
+    ))
+
+    def update():
+        return import_file(engine_postgresql, "update", filepath,
+                           update=True, batch_size=10)
+
+    update()
+    query = text("SELECT object_id, id FROM update.city_object")
+    with engine_postgresql.connect() as conn:
+        before = dict(conn.execute(query).all())
+
+    filepath.write_bytes(b"".join(lines))
+    # only the changed and the added features are imported
+    assert update().added_objects < 592
+    # the file did not change since the update
+    assert update().added_objects == 0
+
+    with engine_postgresql.connect() as conn:
+        after = dict(conn.execute(query).all())
+        imports = conn.execute(text(
+            "SELECT imported_features FROM update.cj_metadata"
+        )).scalars().all()
+        features_count = conn.execute(text(
+            "SELECT count(*) FROM update.cj_feature"
+        )).scalar()
+    assert len(after) == 592
+    assert imports == [len(features)]
+    assert features_count == len(features)
+    # the objects of the unchanged features are kept
+    unchanged = set(before) - set(changed["CityObjects"])
+    assert all(after[object_id] == before[object_id]
+               for object_id in unchanged)
+    assert all(after[object_id] != before[object_id]
+               for object_id in changed["CityObjects"])
+
+
+def test_duplicate_object_ids(engine_postgresql, tmp_path):
+    with open("./tests/files/cube_cjv2.city.jsonl", "rb") as f:
+        metadata = f.readline()
+    # the object "a" is in both features, with another child
+    features = [
+        {"type": "CityJSONFeature", "id": feature_id, "vertices": [],
+         "CityObjects": {
+             "a": {"type": "Building", "children": [child]},
+             child: {"type": "BuildingPart", "parents": ["a"]},
+         }}
+        for feature_id, child in (("f1", "b"), ("f2", "c"))
+    ]
+    filepath = tmp_path / "duplicates.jsonl"
+    filepath.write_bytes(metadata + b"".join(
+        dumps(feature).encode() + b"\n" for feature in features
+    ))
+
+    importer = import_file(engine_postgresql, "duplicates", filepath,
+                           input_srid=28992)
+    assert importer.added_objects == 3
+
+    # the relationship of the skipped object is skipped too
+    with engine_postgresql.connect() as conn:
+        relationships = conn.execute(text("""
+            SELECT p.object_id, c.object_id
+            FROM duplicates.city_object_relationships r
+            JOIN duplicates.city_object p ON p.id = r.parent_id
+            JOIN duplicates.city_object c ON c.id = r.child_id""")).all()
+    assert [tuple(row) for row in relationships] == [("a", "b")]
+
+
+def test_keep_templates(engine_postgresql, tmp_path):
+    import_file(engine_postgresql, "templates",
+                "./tests/files/geomtemplate.city.jsonl", input_srid=None,
+                keep_templates=True)
+
+    with engine_postgresql.connect() as conn:
+        row = conn.execute(text(
+            "SELECT geometry, ST_Area(ground_geometry) AS area "
+            "FROM templates.city_object WHERE object_id = 'mybigtree'"
+        )).one()
+    assert row.geometry[0]["type"] == "GeometryInstance"
+    assert row.geometry[0]["boundaries"] == [[85174.0, 446875.0, 0.0]]
+    assert row.area == 100
+
+    metadata, feature = export_schema(engine_postgresql, "templates",
+                                      tmp_path / "exported.jsonl")
+    assert len(metadata["geometry-templates"]["templates"]) == 1
+    geometry = feature["CityObjects"]["mybigtree"]["geometry"][0]
+    assert geometry["type"] == "GeometryInstance"
+    assert geometry["template"] == 0
+    assert geometry["boundaries"] == [0]
+    assert feature["vertices"] == [[0, 0, 0]]
+
+
+def test_compact_storage(engine_postgresql, batches, tmp_path):
+    import_file(engine_postgresql, "compact", storage="compact")
+
+    # the decoded geometries are the ones stored as json
+    with engine_postgresql.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT co.vertices IS NOT NULL AS compact,
+                   compact.cj_decode_geometry(co.geometry, co.vertices,
+                                              m.transform) AS geometry,
+                   b.geometry AS json_geometry,
+                   ST_Equals(co.ground_geometry, b.ground_geometry)
+                       AS same_ground_geometry
+            FROM compact.city_object co
+            JOIN compact.cj_metadata m ON m.id = co.cj_metadata_id
+            JOIN batches.city_object b ON b.object_id = co.object_id
+            WHERE co.geometry IS NOT NULL""")).all()
+    assert len(rows) > 0
+    for row in rows:
+        assert row.compact
+        assert row.geometry == row.json_geometry
+        assert row.same_ground_geometry
+
+    metadata, *features = export_schema(engine_postgresql, "compact",
+                                        tmp_path / "exported.jsonl")
+    assert sum(len(feature["CityObjects"]) for feature in features) == 592
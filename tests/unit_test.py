@@ -1,11 +1,35 @@
+import io
+
+import numpy as np
 import pytest
+import shapely
 from pytest import approx
 from shapely.geometry import MultiPolygon, Polygon
 
+from cjdb.model.sqlalchemy_models import CjObjectModel
+from cjdb.modules.codec import dumps, loads
 from cjdb.modules.exceptions import InvalidLodException
-from cjdb.modules.geometric import (get_flattened_polygons_from_boundaries,
+from cjdb.modules.exporter import (merge_geometry_templates,
+                                   reference_compact_vertices_in_cjf,
+                                   reference_vertices_in_cjf, write_cjf)
+from cjdb.modules.extensions import ExtensionCache, ExtensionHandler
+from cjdb.modules.geometric import (TemplateResolver, get_coordinate_rings,
+                                    get_extent,
+                                    get_flattened_polygons_from_boundaries,
                                     get_geometry_with_minimum_lod,
-                                    get_ground_geometry, get_ground_surfaces)
+                                    get_ground_geometry, get_ground_surfaces,
+                                    get_ring_arrays, get_ring_normals,
+                                    get_semantic_selection, get_transformer,
+                                    reproject_vertex_list, reproject_vertices,
+                                    resolve, transform_vertices)
+from cjdb.modules.importer import FeatureReader
+from cjdb.modules.loader import rows_to_copy_buffer
+from cjdb.modules.processing import (OBJECT_COLUMNS, FeatureContext,
+                                     get_geometries, process_feature,
+                                     process_line)
+from cjdb.modules.storage import decode_geometry, encode_geometry
+from cjdb.modules.utils import (get_feature_hash, get_file_hash, get_hash_key,
+                                hash_file, new_file_hash)
 
 boundary_multipoint_single_point = [[121483.808, 484844.936, 0.0]]
 boundary_multipoint_many_points = [
@@ -148,3 +172,474 @@ def test_get_ground_surfaces():
                                           (1, 0),
                                           (0, 0),
                                           (0, 1)))
+
+
+def test_get_ring_normals():
+    coords, lengths = get_ring_arrays(get_coordinate_rings(boundary_solid))
+    normals = get_ring_normals(coords, lengths)
+    assert normals.shape == (6, 3)
+    assert normals[0].tolist() == [0.0, 0.0, 1.0]
+    assert normals[1].tolist() == [0.0, -1.0, 0.0]
+    assert normals[5].tolist() == [0.0, 0.0, -1.0]
+
+
+def test_get_ground_geometry_split_ground_surface():
+    # the ground of the box is split in two surfaces at the same height
+    boundaries = [
+        [[0.0, 0.0, 1.0], [2.0, 0.0, 1.0], [2.0, 1.0, 1.0], [0.0, 1.0, 1.0]],
+        [[0.0, 1.0, 0.0], [1.0, 1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 0.0]],
+        [[1.0, 1.0, 0.0], [2.0, 1.0, 0.0], [2.0, 0.0, 0.0], [1.0, 0.0, 0.0]],
+        [[0.0, 0.0, 0.0], [2.0, 0.0, 0.0], [2.0, 0.0, 1.0], [0.0, 0.0, 1.0]],
+    ]
+    geometry = {"type": "MultiSurface", "lod": "2", "boundaries": boundaries}
+    ground_geometry = get_ground_geometry([geometry], "test")
+    assert ground_geometry.area == approx(2.0)
+
+
+def test_get_semantic_selection():
+    geometry = {
+        "type": "Solid",
+        "lod": "2",
+        "boundaries": boundary_solid,
+        "semantics": {
+            "surfaces": [{"type": "RoofSurface"}, {"type": "GroundSurface"}],
+            "values": [[0, None, None, None, None, 1]],
+        },
+    }
+    selection = get_semantic_selection(geometry)
+    assert selection.tolist() == [False] * 5 + [True]
+    geometry["semantics"]["values"] = [[0, None, None, None, None, None]]
+    assert not get_semantic_selection(geometry).any()
+    del geometry["semantics"]
+    assert get_semantic_selection(geometry) is None
+
+
+def test_get_ground_geometry_semantics():
+    # a tagged ground surface is used even if it is not the lowest one
+    geometry = {
+        "type": "MultiSurface",
+        "lod": "2",
+        "boundaries": boundary_solid[0],
+        "semantics": {
+            "surfaces": [{"type": "GroundSurface"}],
+            "values": [0, None, None, None, None, None],
+        },
+    }
+    ground_geometry = get_ground_geometry([geometry], "test")
+    assert ground_geometry.area == approx(1.0)
+    assert list(ground_geometry.geoms[0].exterior.coords)[0] == (0.0, 0.0)
+
+
+def test_rows_to_copy_buffer():
+    table = CjObjectModel.__table__
+    columns = [table.c.id, table.c.object_id, table.c.attributes]
+    rows = [
+        {"id": 1, "object_id": "a", "attributes": {"note": "tab\there"}},
+        {"id": 2, "object_id": "b\\c", "attributes": None},
+    ]
+    buffer = rows_to_copy_buffer(rows, columns)
+    assert buffer.read().split("\n") == [
+        '1\ta\t{"note":"tab\\\\there"}',
+        "2\tb\\\\c\t\\N",
+        "",
+    ]
+
+    buffer = rows_to_copy_buffer([{"vertices": [1, -2, 3]},
+                                  {"vertices": None}],
+                                 [table.c.vertices])
+    assert buffer.read() == "{1,-2,3}\n\\N\n"
+
+
+def test_get_transformer_is_cached():
+    assert get_transformer(28992, 4326) is get_transformer(28992, 4326)
+    assert get_transformer(28992, 4326) is not get_transformer(4326, 28992)
+
+
+def test_reproject_vertex_list():
+    res = reproject_vertex_list([[155000.0, 463000.0, 0.0]], 28992, 4326)
+    assert res[0][0] == approx(5.387, abs=1e-3)
+    assert res[0][1] == approx(52.155, abs=1e-3)
+
+
+@pytest.mark.filterwarnings("error")
+def test_reproject_single_vertex():
+    vertices = np.array([[155000.0, 463000.0, 0.0], [85000.0, 446000.0, 0.0]])
+    res = reproject_vertices(vertices[:1], 28992, 4326)
+    assert res.shape == (1, 3)
+    assert res == approx(reproject_vertices(vertices, 28992, 4326)[:1])
+    assert reproject_vertices(vertices[:0], 28992, 4326).shape == (0, 3)
+
+
+def test_transform_vertices():
+    transform = {"scale": [0.001, 0.001, 0.01], "translate": [10, 20, 30]}
+    res = transform_vertices([[1000, 2000, 300], [0, 0, 0]], transform)
+    assert res.shape == (2, 3)
+    assert res.tolist() == [[11.0, 22.0, 33.0], [10.0, 20.0, 30.0]]
+
+
+def test_resolve_solid():
+    vertices = transform_vertices(
+        [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]],
+        {"scale": [1, 1, 1], "translate": [0, 0, 0]}
+    )
+    geometry = {"type": "Solid", "boundaries": [[[[0, 1, 2, 3]], [[3, 2]]]]}
+    res = resolve(geometry, vertices, inplace=False)
+    assert res["boundaries"] == [[
+        [[[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [0.0, 1.0, 0.0]]],
+        [[[0.0, 1.0, 0.0], [1.0, 1.0, 0.0]]],
+    ]]
+    assert geometry["boundaries"] == [[[[0, 1, 2, 3]], [[3, 2]]]]
+
+
+def test_resolve_multipoint():
+    geometry = {"type": "MultiPoint", "boundaries": [1, 0]}
+    res = resolve(geometry, [[0.0, 0.0, 0.0], [1.0, 2.0, 3.0]])
+    assert res["boundaries"] == [[1.0, 2.0, 3.0], [0.0, 0.0, 0.0]]
+
+
+geometry_templates = {
+    "vertices-templates": [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                           [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1]],
+    "templates": [{"type": "MultiSurface", "lod": "1",
+                   "boundaries": [[[0, 3, 2, 1]], [[4, 5, 6, 7]],
+                                  [[0, 1, 5, 4]]]}],
+}
+
+
+def test_template_resolver():
+    resolver = TemplateResolver(geometry_templates)
+    instance = {"type": "GeometryInstance", "template": 0,
+                "boundaries": [0],
+                "transformationMatrix": [2, 0, 0, 0, 0, 2, 0, 0,
+                                         0, 0, 2, 0, 0, 0, 0, 1]}
+    res = resolver.resolve(instance, np.array([10.0, 20.0, 0.0]))
+    assert res["type"] == "MultiSurface"
+    assert res["boundaries"][0] == [[
+        [10.0, 20.0, 0.0], [10.0, 22.0, 0.0],
+        [12.0, 22.0, 0.0], [12.0, 20.0, 0.0],
+    ]]
+    assert res["boundaries"][1][0][2] == [12.0, 22.0, 2.0]
+    # the transformed template is reused by instances with the same matrix
+    resolver.resolve(instance, np.array([0.0, 0.0, 0.0]))
+    assert len(resolver.transformed) == 1
+    assert geometry_templates["templates"][0]["boundaries"][0] == \
+        [[0, 3, 2, 1]]
+
+    ground_geometry = resolver.get_ground_geometry(
+        instance, np.array([10.0, 20.0, 0.0]), "id"
+    )
+    assert ground_geometry.bounds == (10.0, 20.0, 12.0, 22.0)
+    assert len(resolver.ground_geometries) == 1
+
+
+def test_get_geometries_keep_templates():
+    context = FeatureContext(None, geometry_templates, 7415, 7415, [], [],
+                             keep_templates=True)
+    instance = {"type": "GeometryInstance", "template": 0,
+                "boundaries": [1],
+                "transformationMatrix": [1, 0, 0, 0, 0, 1, 0, 0,
+                                         0, 0, 1, 0, 0, 0, 0, 1]}
+    cityobj = {"geometry": [instance]}
+    vertices = np.array([[0.0, 0.0, 0.0], [10.0, 20.0, 5.0]])
+    geometry, ground_geometry = get_geometries("id", cityobj, vertices,
+                                               context)
+    assert geometry == [{**instance, "boundaries": [[10.0, 20.0, 5.0]]}]
+    geom = shapely.from_wkb(ground_geometry)
+    assert geom.bounds == (10.0, 20.0, 11.0, 21.0)
+
+    # reprojected instances are expanded
+    context = FeatureContext(None, geometry_templates, 7415, 4326, [], [],
+                             keep_templates=True)
+    assert not context.keep_templates
+
+
+def test_merge_geometry_templates():
+    other = {"vertices-templates": [[0, 0, 0], [1, 1, 1]],
+             "templates": [{"type": "MultiPoint", "lod": "1",
+                            "boundaries": [0, 1]}]}
+    merged, offsets = merge_geometry_templates([(1, geometry_templates),
+                                                (3, other)])
+    assert offsets == {1: 0, 3: 1}
+    assert len(merged["vertices-templates"]) == 10
+    assert merged["templates"][0] == geometry_templates["templates"][0]
+    assert merged["templates"][1]["boundaries"] == [8, 9]
+    assert merge_geometry_templates([]) == (None, {})
+
+
+def test_reference_vertices_in_cjf_instance():
+    instance = {"type": "GeometryInstance", "template": 0,
+                "boundaries": [[10.5, 20.25, 1.0]],
+                "transformationMatrix": [1, 0, 0, 0, 0, 1, 0, 0,
+                                         0, 0, 1, 0, 0, 0, 0, 1]}
+    geometry, vertices = reference_vertices_in_cjf(
+        [instance], 3, [10.0, 20.0, 0.0], offset=4, template_offset=2
+    )
+    assert geometry[0]["boundaries"] == [4]
+    assert geometry[0]["template"] == 2
+    assert vertices == [[500, 250, 1000]]
+    assert instance["template"] == 0
+
+
+def test_reference_compact_vertices_in_cjf():
+    # the stored integers are mapped to the transform of the export,
+    # which has another scale and translate
+    transform = {"scale": [0.01, 0.01, 0.5], "translate": [100.0, 200.0, 0.0]}
+    geometry = [{"type": "MultiSurface", "lod": "1",
+                 "boundaries": [[[0, 1, 2]]]},
+                {"type": "GeometryInstance", "template": 1,
+                 "boundaries": [2],
+                 "transformationMatrix": [1, 0, 0, 0, 0, 1, 0, 0,
+                                          0, 0, 1, 0, 0, 0, 0, 1]}]
+    vertices = [0, 0, 0, 123, -7, 3, 99999, 45, 1]
+    referenced, exported = reference_compact_vertices_in_cjf(
+        geometry, vertices, transform, 3, [99.0, 200.5, 1.0],
+        offset=5, template_offset=2
+    )
+    assert referenced[0]["boundaries"] == [[[5, 6, 7]]]
+    assert referenced[1]["boundaries"] == [7]
+    assert referenced[1]["template"] == 3
+    assert exported == [[1000, -500, -1000], [2230, -570, 500],
+                        [1000990, -50, -500]]
+    assert geometry[0]["boundaries"] == [[[0, 1, 2]]]
+    assert geometry[1]["template"] == 1
+
+    data = {1: {"object_id": "a", "type": "Building", "attributes": None,
+                "geometry": geometry[:1], "vertices": vertices,
+                "cj_metadata_id": 4}}
+    feature = loads(write_cjf(1, [], data, {}, [99.0, 200.5, 1.0],
+                              transforms={4: transform}))
+    assert feature["CityObjects"]["a"]["geometry"][0]["boundaries"] == \
+        [[[0, 1, 2]]]
+    assert feature["vertices"] == exported
+
+
+def test_template_resolver_reprojection():
+    resolver = TemplateResolver(geometry_templates, (7415, 4326))
+    instance = {"type": "GeometryInstance", "template": 0,
+                "boundaries": [0],
+                "transformationMatrix": [1, 0, 0, 0, 0, 1, 0, 0,
+                                         0, 0, 1, 0, 0, 0, 0, 1]}
+    res = resolver.resolve(instance, np.array([85000.0, 446000.0, 0.0]))
+    # the anchor point is reprojected together with the template
+    expected = reproject_vertex_list([[85000, 446000, 0], [85000, 446001, 0]],
+                                     7415, 4326)
+    assert np.array(res["boundaries"][0][0][:2]) == approx(np.array(expected))
+
+
+def test_encode_geometry():
+    geometry = [{"type": "MultiSurface", "lod": "2",
+                 "boundaries": [[[5, 2, 7]], [[7, 2, 9]]]}]
+    vertices = np.arange(30).reshape(10, 3)
+    encoded, object_vertices = encode_geometry(geometry, vertices)
+    assert encoded[0]["boundaries"] == [[[1, 0, 2]], [[2, 0, 3]]]
+    assert object_vertices == [6, 7, 8, 15, 16, 17, 21, 22, 23, 27, 28, 29]
+    assert geometry[0]["boundaries"] == [[[5, 2, 7]], [[7, 2, 9]]]
+
+    transform = {"scale": [0.5, 0.5, 1.0], "translate": [10.0, 20.0, 0.0]}
+    decoded = decode_geometry(encoded, object_vertices, transform)
+    assert decoded[0]["boundaries"][0][0] == [
+        [17.5, 28.0, 17.0], [13.0, 23.5, 8.0], [20.5, 31.0, 23.0],
+    ]
+
+
+def test_process_feature_compact():
+    transform = {"scale": [0.001, 0.001, 0.001], "translate": [0, 0, 0]}
+    context = FeatureContext(transform, None, 7415, 7415, [], [],
+                             storage="compact")
+    feature = {"type": "CityJSONFeature", "id": "f",
+               "CityObjects": {"a": {"type": "Building", "geometry": [
+                   {"type": "MultiSurface", "lod": "0",
+                    "boundaries": [[[3, 2, 1, 0]]]}]}},
+               "vertices": [[0, 0, 0], [1000, 0, 0],
+                            [1000, 1000, 0], [0, 1000, 0]]}
+    row, = process_feature(feature, context)
+    assert row["geometry"][0]["boundaries"] == [[[3, 2, 1, 0]]]
+    assert row["vertices"] == [0, 0, 0, 1000, 0, 0,
+                               1000, 1000, 0, 0, 1000, 0]
+    assert shapely.from_wkb(row["ground_geometry"]).area == approx(1.0)
+    assert row["extent"] == [0.0, 0.0, 0.0, 1.0, 1.0, 0.0]
+
+    # reprojected geometries are stored as json
+    context = FeatureContext(transform, None, 7415, 4326, [], [],
+                             storage="compact")
+    assert not context.compact
+
+
+def test_get_extent():
+    geometry = [
+        {"type": "MultiSolid",
+         "boundaries": [[[[[3.0, 4.0, 5.0], [1.0, 9.0, 9.0],
+                           [2.0, 2.0, 2.0]]]]]},
+        {"type": "MultiPoint", "boundaries": [[0.0, 5.0, 1.0]]},
+        {"type": "GeometryInstance", "template": 0,
+         "boundaries": [[4.0, 3.0, -1.0]]},
+    ]
+    assert get_extent(geometry) == [0.0, 2.0, -1.0, 4.0, 9.0, 9.0]
+    assert get_extent([]) is None
+    assert get_extent(None) is None
+
+
+def test_codec_roundtrip():
+    feature = {"type": "CityJSONFeature", "id": "ä",
+               "vertices": [[1, 2.5, -3]]}
+    encoded = dumps(feature)
+    assert isinstance(encoded, str)
+    assert " " not in encoded
+    assert loads(encoded) == feature
+    assert loads(encoded.encode()) == feature
+
+
+def test_get_geometries_ewkb():
+    context = FeatureContext(None, None, 7415, 7415, [], [])
+    cityobj = {"geometry": [{"type": "MultiSurface", "lod": "0",
+                             "boundaries": [[[0, 1, 2, 3]]]}]}
+    vertices = [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0],
+                [1.0, 1.0, 0.0], [0.0, 1.0, 0.0]]
+    _, ground_geometry = get_geometries("id", cityobj, vertices, context)
+    geom = shapely.from_wkb(ground_geometry)
+    assert shapely.get_srid(geom) == 7415
+    assert geom.area == approx(1.0)
+
+
+def test_feature_reader():
+    lines = [b'{"id": "a"}\n', b"\n", b'{"id": "b"}\n', b'{"id": "c"}']
+    reader = FeatureReader(io.BytesIO(b"".join(lines)), 0)
+
+    assert list(reader) == [lines[0], lines[2], lines[3]]
+    assert list(reader.pending) == [
+        (len(lines[0]), b""),
+        (len(b"".join(lines[:3])), b"\n"),
+        (len(b"".join(lines)), b""),
+    ]
+    # the hash depends on the key but not on the line ending
+    key = b"key"
+    assert get_feature_hash(lines[0], key) == \
+        get_feature_hash('{"id": "a"}', key)
+    assert get_feature_hash(lines[0], key) != get_feature_hash(lines[0])
+
+
+def test_file_hash(tmp_path):
+    content = b'{"type": "CityJSON"}\n\n{"id": "a"}\n\n'
+    filepath = tmp_path / "file.jsonl"
+    filepath.write_bytes(content)
+    key = get_hash_key([4326, 7415])
+
+    # the hash of the file can be continued with the rest of its content
+    file_hash = hash_file(filepath, key, 5)
+    file_hash.update(content[5:])
+    assert file_hash.hexdigest() == get_file_hash(filepath, key)
+    assert hash_file(filepath, key, 0).hexdigest() == \
+        new_file_hash(key).hexdigest()
+
+
+def test_get_hash_key():
+    transform = {"scale": [0.001, 0.001, 0.001], "translate": [1.5, 2, 0]}
+    reordered = {"translate": [1.5, 2, 0], "scale": [0.001, 0.001, 0.001]}
+    assert get_hash_key([7415, transform]) == get_hash_key([7415, reordered])
+    assert get_hash_key([7415, transform]) != get_hash_key([4326, transform])
+
+
+def test_process_line():
+    transform = {"scale": [1, 1, 1], "translate": [0, 0, 0]}
+    context = FeatureContext(transform, None, 7415, 7415, [], [])
+    context.hash_key = b"key"
+    line = dumps({
+        "type": "CityJSONFeature", "id": "f",
+        "CityObjects": {
+            "a": {"type": "Building", "children": ["b"],
+                  "attributes": {"note": "tab\there"}},
+            "b": {"type": "BuildingPart", "parents": ["a"], "geometry": [
+                {"type": "MultiSurface", "lod": "0",
+                 "boundaries": [[[0, 1, 2]]]}]},
+        },
+        "vertices": [[0, 0, 0], [1, 0, 0], [1, 1, 0]],
+    }).encode()
+    feature_hash, feature_id, city_objects = process_line(line, context)
+    assert feature_hash == get_feature_hash(line, b"key")
+    assert feature_id == "f"
+    # the rows are formatted for COPY, without id and cj_metadata_id
+    (a, a_children, a_columns), (b, b_children, b_columns) = city_objects
+    assert (a, a_children, b, b_children) == ("a", ["b"], "b", [])
+    assert a_columns.split("\t") == [
+        "a", "Building", '{"note":"tab\\\\there"}', "\\N", "\\N",
+        "\\N", "\\N", "f",
+    ]
+    assert len(b_columns.split("\t")) == len(OBJECT_COLUMNS)
+
+    # the unchanged features are only hashed
+    context.unchanged = frozenset([feature_hash])
+    assert process_line(line, context) == (feature_hash, None, None)
+
+
+def test_extension_cache(tmp_path, monkeypatch):
+    schema = dumps({"extraAttributes": {}, "extraCityObjects": ["+Noise"],
+                    "extraRootProperties": {}})
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    (mirror / "noise.ext.json").write_text(schema)
+    downloads = []
+
+    def download(self, url):
+        downloads.append(url)
+        return schema
+
+    monkeypatch.setattr(ExtensionCache, "download", download)
+
+    # the mirror is used instead of downloading
+    cache = ExtensionCache(mirror=mirror.as_uri(),
+                           cache_dir=tmp_path / "cache")
+    handler = ExtensionHandler(
+        {"Noise": {"url": "https://example.org/a/noise.ext.json"}}, cache
+    )
+    assert handler.extra_city_objects == ["+Noise"]
+    assert downloads == []
+
+    # the same schema from two urls is downloaded once and stored once
+    urls = ["https://example.org/b/x.ext.json",
+            "https://example.org/c/x.ext.json"]
+    cache = ExtensionCache(cache_dir=tmp_path / "cache")
+    definitions = cache.get_definitions(urls + urls)
+    assert list(definitions.values()) == [schema, schema]
+    assert sorted(downloads) == urls
+    cache.get_definitions(urls)
+    assert len(downloads) == 2
+    objects = tmp_path / "cache" / "extensions" / "objects"
+    assert len(list(objects.iterdir())) == 1
+
+    # expired schemas are still used offline, unknown ones are not
+    offline = ExtensionCache(offline=True, ttl=0,
+                             cache_dir=tmp_path / "cache")
+    assert offline.resolve(urls[0]) == schema
+    assert offline.resolve("https://example.org/d/x.ext.json") is None
+    assert len(downloads) == 2
+
+    # the resolved schemas are kept per cache, with its settings
+    empty = ExtensionCache(offline=True, cache_dir=tmp_path / "empty")
+    assert empty.get_definitions(urls) == {url: None for url in urls}
+
+    # an entry without its download time is not used
+    entry = loads(cache.url_entry(urls[0]).read_text())
+    del entry["fetched_at"]
+    cache.url_entry(urls[0]).write_text(dumps(entry))
+    assert cache.load(urls[0]) == (None, None)
+
+
+def test_write_cjf_grandchildren():
+    surface = [{"type": "MultiSurface", "lod": "1",
+                "boundaries": [[[[1.0, 2.0, 3.0], [2.0, 2.0, 3.0],
+                                 [2.0, 3.0, 3.0]]]]}]
+    data = {
+        1: {"object_id": "a", "type": "Building", "attributes": None,
+            "geometry": None, "cj_metadata_id": 1},
+        2: {"object_id": "b", "type": "BuildingPart", "attributes": None,
+            "geometry": None, "cj_metadata_id": 1},
+        3: {"object_id": "c", "type": "BuildingInstallation",
+            "attributes": None, "geometry": surface, "cj_metadata_id": 1},
+    }
+    feature = loads(write_cjf(1, [2], data, {1: [2], 2: [3]},
+                              [1.0, 2.0, 3.0]))
+    assert feature["CityObjects"]["b"]["children"] == ["c"]
+    assert feature["CityObjects"]["c"]["parents"] == ["b"]
+    assert feature["CityObjects"]["c"]["geometry"][0]["boundaries"] == \
+        [[[0, 1, 2]]]
+    assert feature["vertices"] == [[0, 0, 0], [1000, 0, 0], [1000, 1000, 0]]